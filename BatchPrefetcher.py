@@ -0,0 +1,56 @@
+import numpy as np
+import threading
+import queue
+import time
+
+# Samples mini batches from an experience replay on a background thread and keeps up to num_batches
+# of them ready as contiguous NHWC arrays, so sampling overlaps the previous train step. Writers of the
+# replay have to hold lock while they modify it
+class BatchPrefetcher:
+
+    def __init__(self, replay, batchsize, num_batches=2, lock=None):
+        self.replay = replay
+        self.batchsize = batchsize
+        self.lock = lock or threading.Lock()
+        self.batches = queue.Queue(maxsize=num_batches)
+        self.stopped = threading.Event()
+        # Timing counters: seconds spent sampling on the background thread, seconds get() waited
+        # for a batch and number of batches handed out
+        self.sample_time = 0.0
+        self.wait_time = 0.0
+        self.batches_served = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            with self.lock:
+                batch = self.replay.sample_mini_batch(self.batchsize)
+            # The gathered arrays are private copies, so they can be made contiguous outside the lock
+            batch = {k: np.ascontiguousarray(v) for k, v in batch.items()}
+            self.sample_time += time.perf_counter() - start
+            while not self.stopped.is_set():
+                try:
+                    self.batches.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    # Returns the next ready batch, waiting for one if the queue is empty
+    def get(self):
+        start = time.perf_counter()
+        batch = self.batches.get()
+        self.wait_time += time.perf_counter() - start
+        self.batches_served += 1
+        return batch
+
+    # Fraction of the sampling time hidden behind the consumer, 1 when get() never waited
+    def overlap(self):
+        if self.sample_time == 0:
+            return 0.0
+        return max(0.0, 1.0 - self.wait_time / self.sample_time)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
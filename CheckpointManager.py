@@ -0,0 +1,111 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+
+import numpy as np
+
+# Entries of the index of a checkpoint directory, sorted by step, empty without an index
+def load_index(checkpoint_dir):
+    index_path = os.path.join(checkpoint_dir, "index.json")
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path) as f:
+        return json.load(f)["checkpoints"]
+
+# Saves the variables of a session without blocking the training loop: save() copies their values
+# to host memory with one session.run and a background thread writes them to an .npz file. The
+# directory keeps the keep_last most recent checkpoints plus the keep_best ones with the highest
+# score, listed in index.json with their step, episode and score, so a run can pick a checkpoint
+# without scanning the directory
+class CheckpointManager:
+
+    def __init__(self, session, checkpoint_dir, variables, keep_last=5, keep_best=3):
+        self.session = session
+        self.checkpoint_dir = checkpoint_dir
+        self.variables = variables
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.index_path = os.path.join(checkpoint_dir, "index.json")
+        self.checkpoints = load_index(checkpoint_dir)
+        # At most two snapshots wait for the writer, save() blocks beyond that
+        self.snapshots = queue.Queue(maxsize=2)
+        # The first exception of the writer, raised again by wait()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Snapshots the variables and queues them for writing, returns the index entry of the checkpoint
+    def save(self, step, episode, score):
+        values = self.session.run(self.variables)
+        entry = dict(path="ckpt-%i.npz" % step, step=int(step), episode=int(episode), score=float(score), time=time.time())
+        self.snapshots.put((entry, {v.name.split(":")[0]: value for v, value in zip(self.variables, values)}))
+        return entry
+
+    def run(self):
+        while True:
+            entry, values = self.snapshots.get()
+            try:
+                self.write(entry, values)
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self.snapshots.task_done()
+
+    def write(self, entry, values):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        path = os.path.join(self.checkpoint_dir, entry["path"])
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, **values)
+        os.replace(path + ".tmp", path)
+
+        checkpoints = [c for c in self.checkpoints if c["path"] != entry["path"]] + [entry]
+        by_step = sorted(checkpoints, key=lambda c: c["step"])
+        by_score = sorted(checkpoints, key=lambda c: c["score"])
+        # Counted from the start of the lists, [-0:] would keep them whole
+        kept = by_step[len(by_step) - self.keep_last:]
+        kept += [c for c in by_score[len(by_score) - self.keep_best:] if c not in kept]
+        self.checkpoints = sorted(kept, key=lambda c: c["step"])
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(dict(checkpoints=self.checkpoints), f, indent=1)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+        for c in checkpoints:
+            if c not in kept and os.path.exists(os.path.join(self.checkpoint_dir, c["path"])):
+                os.remove(os.path.join(self.checkpoint_dir, c["path"]))
+
+    # Waits until the queued checkpoints are written, raises the exception of a write that failed
+    def wait(self):
+        self.snapshots.join()
+        if self.error is not None:
+            raise self.error
+
+    # Index entries of the most recent and of the highest scoring checkpoint, None without checkpoints
+    def latest(self):
+        return max(self.checkpoints, key=lambda c: c["step"]) if self.checkpoints else None
+
+    def best(self):
+        return max(self.checkpoints, key=lambda c: c["score"]) if self.checkpoints else None
+
+    def checkpoint_file(self, entry):
+        return os.path.join(self.checkpoint_dir, entry["path"])
+
+    # Loads the values of a checkpoint into the variables
+    def restore(self, entry):
+        with np.load(self.checkpoint_file(entry)) as values:
+            for v in self.variables:
+                v.load(values[v.name.split(":")[0]], self.session)
+        return entry
+
+    # Loads the latest checkpoint of tf.train.Saver, for directories written before the index existed.
+    # Returns an index entry without episode and score, None without such a checkpoint
+    def restore_saver_checkpoint(self):
+        import tensorflow as tf
+        ckpt = tf.compat.v1.train.get_checkpoint_state(self.checkpoint_dir)
+        if ckpt is None:
+            return None
+        tf.compat.v1.train.Saver(self.variables).restore(self.session, ckpt.model_checkpoint_path)
+        step = int(re.findall(r"-(\d+)$", ckpt.model_checkpoint_path)[0])
+        return dict(path=os.path.basename(ckpt.model_checkpoint_path), step=step, episode=0, score=float("nan"), time=None)
@@ -1,13 +1,33 @@
 import numpy as np
+import json
+import os
 
 class ExperienceReplay:
 
-    def __init__(self, num_frame_stack=4, capacity=int(1e5), pic_size=(96, 96)):
+    # frame_dtype is the dtype frames are stored with. Frames are in the [-1, 1] range of
+    # processimage, uint8 quantizes them to 256 levels and float16 halves the float32 size.
+    # Frames are converted back to float32 only for the states that are returned
+    #
+    # With storage_dir the arrays are np.memmap files in that directory, so the capacity is
+    # bounded by disk instead of RAM. flush() records how many experiences were added and
+    # resume=True reopens the files of a previous run with that counter
+    #
+    # buffers maps cache names to arrays allocated by the caller, e.g. in shared memory,
+    # shaped as given by cache_specs
+    def __init__(self, num_frame_stack=4, capacity=int(1e5), pic_size=(96, 96), frame_dtype="uint8",
+            storage_dir=None, resume=False, buffers=None):
         self.num_frame_stack = num_frame_stack
         self.capacity = capacity
         self.pic_size = pic_size
+        self.frame_dtype = np.dtype(frame_dtype)
+        assert self.frame_dtype in (np.uint8, np.float16, np.float32), "unsupported frame dtype %s" % frame_dtype
+        self.storage_dir = storage_dir
+        self.buffers = buffers
+        if storage_dir is not None:
+            os.makedirs(storage_dir, exist_ok=True)
         self.counter = 0
         self.frame_window = None
+        self.resume = resume and self.load_metadata()
         self.init_caches()
         self.expecting_new_episode = True
 
@@ -22,7 +42,7 @@ class ExperienceReplay:
         self.next_states[exp_idx] = self.frame_window
         self.actions[exp_idx] = action
         self.is_done[exp_idx] = done
-        self.frames[frame_idx] = frame
+        self.frames[frame_idx] = self.encode_frames(frame)
         self.rewards[exp_idx] = reward
         if done:
             self.expecting_new_episode = True
@@ -33,15 +53,18 @@ class ExperienceReplay:
         assert self.expecting_new_episode, "previous episode didn't end yet"
         frame_idx = self.counter % self.max_frame_cache
         self.frame_window = np.repeat(frame_idx, self.num_frame_stack)
-        self.frames[frame_idx] = frame
+        self.frames[frame_idx] = self.encode_frames(frame)
         self.expecting_new_episode = False
 
     def sample_mini_batch(self, n):
         count = min(self.capacity, self.counter)
         batchidx = np.random.randint(count, size=n)
+        return self.get_batch(batchidx)
 
-        prev_frames = self.frames[self.prev_states[batchidx]]
-        next_frames = self.frames[self.next_states[batchidx]]
+    # Gathers the experiences at batchidx as a mini batch
+    def get_batch(self, batchidx):
+        prev_frames = self.decode_frames(self.frames[self.prev_states[batchidx]])
+        next_frames = self.decode_frames(self.frames[self.next_states[batchidx]])
         prev_frames = np.moveaxis(prev_frames, 1, -1)
         next_frames = np.moveaxis(next_frames, 1, -1)
         return {
@@ -56,18 +79,284 @@ class ExperienceReplay:
         # assert not self.expecting_new_episode, "start new episode first"'
         assert self.frame_window is not None, "do something first"
 
-        sf = self.frames[self.frame_window]
+        sf = self.decode_frames(self.frames[self.frame_window])
         sf = np.moveaxis(sf, 0, -1)
         return sf
 
     def init_caches(self):
-        self.rewards = np.zeros(self.capacity, dtype="float32")
-        self.prev_states = -np.ones((self.capacity, self.num_frame_stack),
-            dtype="int32")
-        self.next_states = -np.ones((self.capacity, self.num_frame_stack),
-            dtype="int32")
-        self.is_done = -np.ones(self.capacity, "int32")
-        self.actions = -np.ones(self.capacity, dtype="int32")
-
         self.max_frame_cache = self.capacity + 2 * self.num_frame_stack + 1
-        self.frames = -np.ones((self.max_frame_cache,) + self.pic_size, dtype="float32")
\ No newline at end of file
+        specs = self.cache_specs(self.num_frame_stack, self.capacity, self.pic_size, self.frame_dtype)
+        for name, (shape, dtype, fill_value) in specs.items():
+            setattr(self, name, self.create_array(name, shape, dtype, fill_value))
+
+    # Shape, dtype and initial value of every cache
+    @staticmethod
+    def cache_specs(num_frame_stack, capacity, pic_size, frame_dtype):
+        max_frame_cache = capacity + 2 * num_frame_stack + 1
+        # Empty frames are -1, which uint8 frames encode as 0
+        empty_frame = 0 if np.dtype(frame_dtype) == np.uint8 else -1
+        return {
+            "rewards": ((capacity,), np.dtype("float32"), 0),
+            "prev_states": ((capacity, num_frame_stack), np.dtype("int32"), -1),
+            "next_states": ((capacity, num_frame_stack), np.dtype("int32"), -1),
+            "is_done": ((capacity,), np.dtype("int32"), -1),
+            "actions": ((capacity,), np.dtype("int32"), -1),
+            "frames": ((max_frame_cache,) + tuple(pic_size), np.dtype(frame_dtype), empty_frame),
+        }
+
+    # Allocates a cache filled with fill_value, in memory, in the given buffers or as a memory-mapped
+    # file of storage_dir
+    def create_array(self, name, shape, dtype, fill_value):
+        if self.buffers is not None:
+            array = self.buffers[name]
+            assert array.shape == shape and array.dtype == dtype, "buffer %s does not match the replay" % name
+            array[...] = fill_value
+            return array
+        if self.storage_dir is None:
+            return np.full(shape, fill_value, dtype=dtype)
+        path = os.path.join(self.storage_dir, name + ".dat")
+        if self.resume:
+            return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+        array = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+        # New files read as zeros, which spares touching every page of the frames
+        if fill_value != 0:
+            array[:] = fill_value
+        return array
+
+    def metadata(self):
+        return {
+            "num_frame_stack": self.num_frame_stack,
+            "capacity": self.capacity,
+            "pic_size": list(self.pic_size),
+            "frame_dtype": self.frame_dtype.name,
+        }
+
+    # Reads the counter of a previous run from storage_dir, returns whether there is one to resume
+    def load_metadata(self):
+        if self.storage_dir is None:
+            return False
+        path = os.path.join(self.storage_dir, "replay.json")
+        if not os.path.exists(path):
+            print("no experience replay found in %s, starting a new one" % self.storage_dir)
+            return False
+        with open(path) as f:
+            metadata = json.load(f)
+        counter = metadata.pop("counter")
+        assert metadata == self.metadata(), "experience replay in %s was created with %s" % (self.storage_dir, metadata)
+        self.counter = counter
+        return True
+
+    # Writes memory-mapped caches to disk and records the counter so they can be resumed.
+    # Call it between episodes, the frames of an unfinished episode are overwritten on resume
+    def flush(self):
+        if self.storage_dir is None:
+            return
+        for array in (self.frames, self.rewards, self.prev_states, self.next_states, self.is_done, self.actions):
+            array.flush()
+        metadata = self.metadata()
+        metadata["counter"] = self.counter
+        path = os.path.join(self.storage_dir, "replay.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(metadata, f)
+        os.replace(path + ".tmp", path)
+
+    # Converts frames in the [-1, 1] range to the stored dtype. Frames that already have the stored
+    # dtype, e.g. from processimage.process_image, are stored as they are
+    def encode_frames(self, frames):
+        if self.frame_dtype == np.uint8 and np.asarray(frames).dtype != np.uint8:
+            return np.rint((np.asarray(frames) + 1) * 127.5).clip(0, 255).astype(np.uint8)
+        return np.asarray(frames, dtype=self.frame_dtype)
+
+    # Converts stored frames back to float32 in the [-1, 1] range
+    def decode_frames(self, frames):
+        decoded = frames.astype(np.float32)
+        if self.frame_dtype == np.uint8:
+            decoded *= 1 / 127.5
+            decoded -= 1
+        return decoded
+
+    # Bytes used by the replay arrays
+    def memory_usage(self):
+        arrays = (self.frames, self.rewards, self.prev_states, self.next_states, self.is_done, self.actions)
+        return sum(a.nbytes for a in arrays)
+
+# Stores every transition with its own copy of the previous and next state. For the short feature
+# vectors of RaceCarEnv's state observation this is smaller and simpler than a frame stack of
+# shared frames. Offers the interface of ExperienceReplay the agent uses
+class TransitionReplay:
+
+    def __init__(self, capacity=int(1e5), state_features=11, frame_dtype="float32"):
+        self.capacity = capacity
+        self.state_features = state_features
+        self.frame_dtype = np.dtype(frame_dtype)
+        self.counter = 0
+        self.state = None
+        self.prev_states = np.zeros((capacity, state_features), dtype=self.frame_dtype)
+        self.next_states = np.zeros((capacity, state_features), dtype=self.frame_dtype)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.actions = np.full(capacity, -1, dtype=np.int32)
+        self.is_done = np.full(capacity, -1, dtype=np.int32)
+
+    def add_experience(self, frame, action, done, reward):
+        assert self.state is not None, "start episode first"
+        self.counter += 1
+        exp_idx = (self.counter - 1) % self.capacity
+        self.prev_states[exp_idx] = self.state
+        self.next_states[exp_idx] = frame
+        self.state[...] = frame
+        self.actions[exp_idx] = action
+        self.is_done[exp_idx] = done
+        self.rewards[exp_idx] = reward
+
+    def start_new_episode(self, frame):
+        self.state = np.array(frame, dtype=self.frame_dtype)
+
+    def sample_mini_batch(self, n):
+        count = min(self.capacity, self.counter)
+        batchidx = np.random.randint(count, size=n)
+        return {
+            "reward": self.rewards[batchidx],
+            "prev_state": self.prev_states[batchidx].astype(np.float32),
+            "next_state": self.next_states[batchidx].astype(np.float32),
+            "actions": self.actions[batchidx],
+            "done_mask": self.is_done[batchidx]
+        }
+
+    def current_state(self):
+        assert self.state is not None, "do something first"
+        return self.state.astype(np.float32)
+
+    # Transitions are only kept in memory
+    def flush(self):
+        pass
+
+    def memory_usage(self):
+        arrays = (self.prev_states, self.next_states, self.rewards, self.actions, self.is_done)
+        return sum(a.nbytes for a in arrays)
+
+# The states the agent acts on, kept in one contiguous float32 array of shape (num_states,) + frame_shape +
+# (num_frame_stack,) that is updated in place as frames arrive. It is the network input of num_states
+# states as it is, without gathering and transposing frames like current_state. uint8 frames are decoded
+# like ExperienceReplay.decode_frames. Without num_frame_stack only the latest frame is kept, without a
+# stack axis, as for the feature vectors of state observations. index selects the states a frame is for,
+# an int or a slice
+class FrameStack:
+
+    def __init__(self, frame_shape, num_frame_stack=None, num_states=1):
+        self.num_frame_stack = num_frame_stack
+        stack_shape = (num_frame_stack,) if num_frame_stack else ()
+        self.states = np.zeros((num_states,) + tuple(frame_shape) + stack_shape, dtype=np.float32)
+
+    # Fills the stacks with frame, at the start of an episode
+    def reset(self, frame, index=slice(None)):
+        frame = np.asarray(frame)
+        self.states[index] = frame[..., np.newaxis] if self.num_frame_stack else frame
+        if frame.dtype == np.uint8:
+            self.states[index] *= 1 / 127.5
+            self.states[index] -= 1
+
+    # Appends frame to the stacks, dropping their oldest frame
+    def push(self, frame, index=slice(None)):
+        if not self.num_frame_stack:
+            return self.reset(frame, index)
+        stacks = self.states[index]
+        # Moving all values of the contiguous stacks one element back moves every frame one channel back,
+        # the first channel of the next pixel lands in the last channel, which the new frame overwrites
+        values = stacks.reshape(-1)
+        values[:-1] = values[1:]
+        last = stacks[..., -1]
+        if np.asarray(frame).dtype == np.uint8:
+            np.multiply(frame, np.float32(1 / 127.5), out=last)
+            last -= 1
+        else:
+            last[...] = frame
+
+# Binary tree over the experience slots where every node holds the sum of its children, so
+# sampling proportionally to the leaf priorities and updating them are both O(log N).
+# Leaves are stored after the internal nodes in one array, the root is nodes[1]
+class SumTree:
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.num_leaves = 1 << max(capacity - 1, 1).bit_length()
+        self.nodes = np.zeros(2 * self.num_leaves, dtype="float64")
+
+    def total(self):
+        return self.nodes[1]
+
+    def get(self, indices):
+        return self.nodes[np.asarray(indices) + self.num_leaves]
+
+    # Sets the priorities of a batch of leaves and recomputes the sums above them level by level
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices) + self.num_leaves
+        self.nodes[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.nodes[nodes] = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    # Finds for each value the leaf whose prefix sum range contains it, for a batch of values
+    def find(self, values):
+        values = np.array(values, dtype="float64")
+        nodes = np.ones(len(values), dtype="int64")
+        while nodes[0] < self.num_leaves:
+            left = self.nodes[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return np.minimum(nodes - self.num_leaves, self.capacity - 1)
+
+
+# Samples experiences proportionally to priority^alpha, where the priority is the absolute TD error
+# of their last update. New experiences get the highest priority seen so far so they are replayed at
+# least once. The bias this introduces is corrected with importance sampling weights whose exponent
+# beta is annealed from beta to 1 over beta_annealing_samples sampled batches
+class PrioritizedExperienceReplay(ExperienceReplay):
+
+    def __init__(self, num_frame_stack=4, capacity=int(1e5), pic_size=(96, 96), alpha=0.6, beta=0.4,
+            beta_annealing_samples=int(1e5), priority_epsilon=1e-6, **kwargs):
+        self.alpha = alpha
+        self.initial_beta = beta
+        self.beta_annealing_samples = beta_annealing_samples
+        self.priority_epsilon = priority_epsilon
+        self.max_priority = 1.0
+        self.samples_drawn = 0
+        self.sum_tree = SumTree(capacity)
+        super().__init__(num_frame_stack, capacity=capacity, pic_size=pic_size, **kwargs)
+        # Experiences of a resumed replay start out with equal priorities
+        count = min(self.capacity, self.counter)
+        if count > 0:
+            self.sum_tree.update(np.arange(count), self.max_priority ** self.alpha)
+
+    def add_experience(self, frame, action, done, reward):
+        super().add_experience(frame, action, done, reward)
+        exp_idx = (self.counter - 1) % self.capacity
+        self.sum_tree.update([exp_idx], self.max_priority ** self.alpha)
+
+    def get_beta(self):
+        fraction = min(1.0, self.samples_drawn / float(self.beta_annealing_samples))
+        return self.initial_beta + (1.0 - self.initial_beta) * fraction
+
+    def sample_mini_batch(self, n):
+        count = min(self.capacity, self.counter)
+        # Stratified sampling: one value from each of n equal slices of the total priority
+        total = self.sum_tree.total()
+        values = (np.arange(n) + np.random.rand(n)) * (total / n)
+        batchidx = self.sum_tree.find(values)
+
+        probabilities = self.sum_tree.get(batchidx) / total
+        weights = (count * probabilities) ** -self.get_beta()
+        weights /= weights.max()
+        self.samples_drawn += 1
+
+        batch = self.get_batch(batchidx)
+        batch["indices"] = batchidx
+        batch["weights"] = weights.astype("float32")
+        return batch
+
+    # Sets the priorities of sampled experiences from the absolute TD errors of the train step
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.priority_epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.sum_tree.update(indices, priorities ** self.alpha)
@@ -2,13 +2,28 @@ import pygame
 from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
+import numpy as np
+import ctypes
 import cv2
 import math
+import time
+from Profiler import DISABLED
+from Track import load_track
 
 class Graphics():
-	def __init__(self):
+	# offscreen draws the observation into a state_size framebuffer object and reads it back through
+	# two pixel buffer objects. The window is then only for humans: it can be hidden (show_window=False)
+	# and is redrawn every display_every frames. With readback_latency=1 the transfer of a frame is
+	# only waited for in the next call, so it overlaps the next draw, at the cost of returning the
+	# observation one step late (the first frame after a reset is always read synchronously).
+	# In both modes the window, its stats and path are redrawn and its events handled at most
+	# display_fps times a second, independent of the simulation rate. The path keeps the last path_capacity
+	# dots of the car, with path_spacing metres or more between two dots.
+	# track is the Track to draw, the default track when None
+	def __init__(self, track=None, offscreen=False, show_window=True, display_every=10, display_fps=30, readback_latency=0, samples=4, state_size=(96, 96), path_capacity=5000, path_spacing=0):
 		# CONSTANTS #
-		self.track_thickness = 10
+		self.track = track or load_track()
+		self.track_thickness = self.track.width
 		self.hf_thickness = self.track_thickness/2 #half track thickness
 		self.car_length = 2
 		self.car_width = 1
@@ -21,8 +36,11 @@ class Graphics():
 		self.car_x = 0
 		self.car_y = 0
 		self.car_a = 0
-		self.path = []
-		self.track_layout = []
+		# Ring buffer of the 4 vertices of each dot of the path
+		self.path = np.zeros((path_capacity, 4, 3), dtype=np.float32)
+		self.path_capacity = path_capacity
+		self.path_spacing = path_spacing
+		self.clear_path()
 
 		# variables for manual WASD control
 		self.car_speed = 0.2 # metre per frame
@@ -32,9 +50,28 @@ class Graphics():
 		self.s_pressed_down = False
 		self.d_pressed_down = False
 
+		# variables for offscreen rendering
+		self.offscreen = offscreen
+		self.show_window = show_window
+		self.display_every = display_every if offscreen else 1
+		self.display_interval = 1 / display_fps
+		self.next_display = 0.0
+		self.readback_latency = readback_latency
+		self.state_size = state_size
+		self.samples = samples
+		self.frame_counter = 0
+		self.atlas_views = 0
+		# The font is loaded once and the image of each stats line is kept until its text changes
+		self.font = None
+		self.detail_images = {}
+		self.profiler = DISABLED
+
 		pygame.init()
 		display = (400,400)
-		self.window = pygame.display.set_mode(display, DOUBLEBUF|OPENGL)
+		flags = DOUBLEBUF|OPENGL
+		if not show_window:
+			flags |= HIDDEN
+		self.window = pygame.display.set_mode(display, flags)
 		pygame.display.set_caption("Race Car Environment")
 		glEnable(GL_BLEND)
 		glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
@@ -46,75 +83,235 @@ class Graphics():
 		glMatrixMode(GL_MODELVIEW)
 		glLoadIdentity()
 		self.setCamera(self.car_x, self.car_y, self.car_a)
-	
+
+		# The scene is static, so its vertices are uploaded once and each frame only issues draw calls
+		self.track_layout = self.track.quad_strip(self.hf_thickness)
+		self.floor_buffer = self.create_vertex_buffer(self.build_floor())
+		self.track_buffer = self.create_vertex_buffer(self.track_layout)
+		self.car_buffer = self.create_vertex_buffer(self.build_race_car())
+		# The path is uploaded as it grows, the dots recorded since the last draw at a time
+		self.path_vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, self.path_vbo)
+		glBufferData(GL_ARRAY_BUFFER, self.path.nbytes, None, GL_DYNAMIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+		if offscreen:
+			self.init_offscreen(samples)
+
+	# Creates the framebuffer objects the observation is drawn into and the pixel buffer objects
+	# it is read back through
+	def init_offscreen(self, samples):
+		w, h = self.state_size
+		self.msaa_fbo, self.resolve_fbo, self.renderbuffers = self.create_framebuffers(w, h, samples)
+
+		# Two pixel buffer objects so one can be filled while the other is read, each with its own host array.
+		# GL rows start at the bottom, transposing gives the [x][y] layout of pygame.surfarray.array3d without a copy
+		glPixelStorei(GL_PACK_ALIGNMENT, 1)
+		self.pbos = glGenBuffers(2)
+		self.frame_buffers = []
+		self.frame_views = []
+		for pbo in self.pbos:
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+			glBufferData(GL_PIXEL_PACK_BUFFER, w * h * 3, None, GL_STREAM_READ)
+			frame_buffer = np.empty((h, w, 3), dtype=np.uint8)
+			self.frame_buffers.append(frame_buffer)
+			self.frame_views.append(frame_buffer.transpose(1, 0, 2))
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+	# Creates a multisampled framebuffer object of w x h pixels that is drawn into, it smooths the edges like
+	# the resize of the window image, and a single sampled one the samples are resolved into before the readback.
+	# Also returns the renderbuffers that hold their pixels, which have to be deleted along with them
+	def create_framebuffers(self, w, h, samples):
+		samples = min(samples, glGetIntegerv(GL_MAX_SAMPLES))
+		msaa_fbo = glGenFramebuffers(1)
+		msaa_rbo = glGenRenderbuffers(1)
+		glBindRenderbuffer(GL_RENDERBUFFER, msaa_rbo)
+		glRenderbufferStorageMultisample(GL_RENDERBUFFER, samples, GL_RGBA8, w, h)
+		glBindFramebuffer(GL_FRAMEBUFFER, msaa_fbo)
+		glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, msaa_rbo)
+		assert glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE, "multisampled framebuffer incomplete"
+
+		resolve_fbo = glGenFramebuffers(1)
+		resolve_rbo = glGenRenderbuffers(1)
+		glBindRenderbuffer(GL_RENDERBUFFER, resolve_rbo)
+		glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, w, h)
+		glBindFramebuffer(GL_FRAMEBUFFER, resolve_fbo)
+		glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, resolve_rbo)
+		assert glCheckFramebufferStatus(GL_FRAMEBUFFER) == GL_FRAMEBUFFER_COMPLETE, "resolve framebuffer incomplete"
+		glBindRenderbuffer(GL_RENDERBUFFER, 0)
+		glBindFramebuffer(GL_FRAMEBUFFER, 0)
+		return msaa_fbo, resolve_fbo, [msaa_rbo, resolve_rbo]
+
+	# Creates the atlas of updateGraphicsBatch: framebuffer objects with a state_size tile per view stacked
+	# from the bottom, a pixel buffer object and the host array it is read into. Tile i of the host array
+	# is its rows i*h to (i+1)*h, so the (N, w, h, 3) views in the layout of updateGraphics are a view
+	def init_atlas(self, num_views):
+		w, h = self.state_size
+		assert num_views * h <= glGetIntegerv(GL_MAX_RENDERBUFFER_SIZE), "too many views for one atlas"
+		if self.atlas_views:
+			glDeleteFramebuffers(2, [self.atlas_msaa_fbo, self.atlas_resolve_fbo])
+			glDeleteRenderbuffers(2, self.atlas_renderbuffers)
+			glDeleteBuffers(1, [self.atlas_pbo])
+		self.atlas_msaa_fbo, self.atlas_resolve_fbo, self.atlas_renderbuffers = self.create_framebuffers(w, num_views * h, self.samples)
+		glPixelStorei(GL_PACK_ALIGNMENT, 1)
+		self.atlas_pbo = glGenBuffers(1)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, self.atlas_pbo)
+		glBufferData(GL_PIXEL_PACK_BUFFER, num_views * w * h * 3, None, GL_STREAM_READ)
+		glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+		self.atlas = np.empty((num_views * h, w, 3), dtype=np.uint8)
+		self.atlas_frames = self.atlas.reshape(num_views, h, w, 3).transpose(0, 2, 1, 3)
+		self.atlas_views = num_views
+
+	# Draws the observations of N cars, given as arrays of their poses, into the tiles of one atlas and reads
+	# them back with a single transfer. Returns an (N, w, h, 3) view of a host array, valid until the next
+	# call. Stats and path are not drawn and the window is not updated
+	def updateGraphicsBatch(self, car_x, car_y, car_a):
+		num_views = len(car_x)
+		if num_views > self.atlas_views:
+			self.init_atlas(num_views)
+		w, h = self.state_size
+		with self.profiler.phase("draw"):
+			glBindFramebuffer(GL_FRAMEBUFFER, self.atlas_msaa_fbo)
+			glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+			for i in range(num_views):
+				glViewport(0, i * h, w, h)
+				self.draw_view(car_x[i], car_y[i], car_a[i])
+
+			glBindFramebuffer(GL_READ_FRAMEBUFFER, self.atlas_msaa_fbo)
+			glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.atlas_resolve_fbo)
+			glBlitFramebuffer(0, 0, w, num_views * h, 0, 0, w, num_views * h, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+
+		with self.profiler.phase("readback"):
+			glBindFramebuffer(GL_READ_FRAMEBUFFER, self.atlas_resolve_fbo)
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, self.atlas_pbo)
+			glReadPixels(0, 0, w, num_views * h, GL_RGB, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+			glGetBufferSubData(GL_PIXEL_PACK_BUFFER, 0, num_views * w * h * 3, self.atlas[:num_views * h])
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+			glBindFramebuffer(GL_FRAMEBUFFER, 0)
+			glViewport(0, 0, *self.window.get_size())
+
+		if self.display_due():
+			self.handle_events()
+		return self.atlas_frames[:num_views]
+
 	# RaceCarEnv calls this function to update the graphics every time step
 	def updateGraphics(self, car_x, car_y, car_a, episode_no, speed, time_elapsed):
 		self.car_x = car_x
 		self.car_y = car_y
 		self.car_a = car_a
-		
-		glMatrixMode(GL_MODELVIEW)
-		glLoadIdentity()
-		self.setCamera(car_x, car_y, car_a)
 
-		for event in pygame.event.get():
-			if event.type == pygame.QUIT:
-				pygame.quit()
-				quit()
-
-		glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
-		
-		# Constructing a track via vertices
-		track_layout = []
-		track_layout.append([self.hf_thickness, 0])
-		track_layout.append([-self.hf_thickness, 0])
-		
-		for i in range (101):
-			x  = -20 + (20 + self.hf_thickness) * math.cos((i / 100) * math.pi)
-			y  = 50 + (20 + self.hf_thickness) * math.sin((i / 100) * math.pi)
-			track_layout.append([x, y])
-			x  = -20 + (20 - self.hf_thickness) * math.cos((i / 100) * math.pi)
-			y  = 50 + (20 - self.hf_thickness) * math.sin((i / 100) * math.pi)
-			track_layout.append([x, y])
-		
-		for i in range (101):
-			x  = -20 + (20 + self.hf_thickness) * math.cos((i / 100) * math.pi + math.pi)
-			y  = 0 + (20 + self.hf_thickness) * math.sin((i / 100) * math.pi + math.pi)
-			track_layout.append([x, y])
-			x  = -20 + (20 - self.hf_thickness) * math.cos((i / 100) * math.pi + math.pi)
-			y  = 0 + (20 - self.hf_thickness) * math.sin((i / 100) * math.pi + math.pi)
-			track_layout.append([x, y])
+		if self.offscreen:
+			return self.updateGraphicsOffscreen(episode_no, speed, time_elapsed)
 
-		# Drawing floor, track and car
-		self.draw_floor()
-		self.draw_race_track(track_layout)
-		self.draw_race_car(car_x, car_y, car_a)
+		display = self.display_due()
+		if display:
+			self.handle_events()
+		with self.profiler.phase("draw"):
+			self.draw_scene(car_x, car_y, car_a)
 	
 		# Get image from the graphics
-		size = self.window.get_size()
-		buffer = glReadPixels(0, 0, *size, GL_RGBA, GL_UNSIGNED_BYTE)
+		with self.profiler.phase("readback"):
+			size = self.window.get_size()
+			buffer = glReadPixels(0, 0, *size, GL_RGBA, GL_UNSIGNED_BYTE)
 
 		# Stats and path are drawn after the image is captured to prevent this from being part
 		# of the image sent to the neural network
-		self.draw_details(episode_no, speed, time_elapsed)
-		self.draw_path()
+		self.update_path()
+		if display:
+			with self.profiler.phase("display"):
+				self.draw_details(episode_no, speed, time_elapsed)
+				self.draw_path()
 
-		# Updating the graphics on screen
-		pygame.display.flip()
+				# Updating the graphics on screen
+				pygame.display.flip()
 
 		# Process and return image
-		screen_surf = pygame.image.fromstring(buffer, size, "RGBA")
-		imgdata = pygame.surfarray.array3d(screen_surf)
-		dim = (96, 96)
-		resized_imagdata = cv2.resize(imgdata, dim, interpolation = cv2.INTER_AREA)
+		with self.profiler.phase("resize"):
+			screen_surf = pygame.image.fromstring(buffer, size, "RGBA")
+			imgdata = pygame.surfarray.array3d(screen_surf)
+			dim = (96, 96)
+			resized_imagdata = cv2.resize(imgdata, dim, interpolation = cv2.INTER_AREA)
 		return resized_imagdata
 
+	# Draws the observation into the framebuffer object and returns it as a view of a host array.
+	# The view stays valid until the second call after this one
+	def updateGraphicsOffscreen(self, episode_no, speed, time_elapsed):
+		w, h = self.state_size
+		with self.profiler.phase("draw"):
+			glBindFramebuffer(GL_FRAMEBUFFER, self.msaa_fbo)
+			glViewport(0, 0, w, h)
+			self.draw_scene(self.car_x, self.car_y, self.car_a)
+
+			glBindFramebuffer(GL_READ_FRAMEBUFFER, self.msaa_fbo)
+			glBindFramebuffer(GL_DRAW_FRAMEBUFFER, self.resolve_fbo)
+			glBlitFramebuffer(0, 0, w, h, 0, 0, w, h, GL_COLOR_BUFFER_BIT, GL_NEAREST)
+
+		# Start the transfer of this frame, then wait for the frame that should be returned
+		with self.profiler.phase("readback"):
+			write_idx = self.frame_counter % 2
+			read_idx = write_idx if self.readback_latency == 0 or self.frame_counter == 0 else 1 - write_idx
+			glBindFramebuffer(GL_READ_FRAMEBUFFER, self.resolve_fbo)
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[write_idx])
+			glReadPixels(0, 0, w, h, GL_RGB, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, self.pbos[read_idx])
+			glGetBufferSubData(GL_PIXEL_PACK_BUFFER, 0, w * h * 3, self.frame_buffers[read_idx])
+			glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+			glBindFramebuffer(GL_FRAMEBUFFER, 0)
+
+		self.frame_counter += 1
+		self.update_path()
+		if self.frame_counter % self.display_every == 0 and self.display_due():
+			self.handle_events()
+			if self.show_window:
+				with self.profiler.phase("display"):
+					self.display(episode_no, speed, time_elapsed)
+		return self.frame_views[read_idx]
+
+	# Redraws the scene, stats and path in the window for humans watching the offscreen renderer
+	def display(self, episode_no, speed, time_elapsed):
+		glViewport(0, 0, *self.window.get_size())
+		self.draw_scene(self.car_x, self.car_y, self.car_a)
+		self.draw_details(episode_no, speed, time_elapsed)
+		self.draw_path()
+		pygame.display.flip()
+
+	# True when the window is due to be refreshed, which happens at most display_fps times a second
+	def display_due(self):
+		now = time.monotonic()
+		if now < self.next_display:
+			return False
+		self.next_display = now + self.display_interval
+		return True
+
+	# Handles the window being closed
+	def handle_events(self):
+		for event in pygame.event.get():
+			if event.type == pygame.QUIT:
+				pygame.quit()
+				quit()
+
+	# Clears the bound framebuffer and draws the floor, track and car seen from the camera above the car
+	def draw_scene(self, car_x, car_y, car_a):
+		glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
+		self.draw_view(car_x, car_y, car_a)
+
+	# Draws the floor, track and car seen from the camera above the car into the viewport
+	def draw_view(self, car_x, car_y, car_a):
+		glMatrixMode(GL_MODELVIEW)
+		glLoadIdentity()
+		self.setCamera(car_x, car_y, car_a)
+
+		# Drawing floor, track and car
+		self.draw_floor()
+		self.draw_race_track(self.track_buffer)
+		self.draw_race_car(car_x, car_y, car_a)
+
 	# Resets the graphics to the initial state
 	def reset_graphics(self):
-		self.path.clear()
-		self.car_x = 0
-		self.car_y = 0
-		self.car_a = 0
+		self.clear_path()
+		self.car_x, self.car_y, heading = self.track.start_pose()
+		self.car_a = heading * 180 / math.pi
+		self.frame_counter = 0
 		state_image = self.updateGraphics(self.car_x, self.car_y, self.car_a, 0, 0, 0)
 		return state_image
 	
@@ -160,28 +357,8 @@ class Graphics():
 			self.car_a += -self.car_handling
 
 		glClear(GL_COLOR_BUFFER_BIT|GL_DEPTH_BUFFER_BIT)
-		track_layout = []
-		track_layout.append([2, 0])
-		track_layout.append([-2, 0])
-		
-		for i in range (101):
-			x  = -20 + 22 * math.cos((i / 100) * math.pi)
-			y  = 50 + 22 * math.sin((i / 100) * math.pi)
-			track_layout.append([x, y])
-			x  = -20 + 18 * math.cos((i / 100) * math.pi)
-			y  = 50 + 18 * math.sin((i / 100) * math.pi)
-			track_layout.append([x, y])
-		
-		for i in range (101):
-			x  = -20 + 22 * math.cos((i / 100) * math.pi + math.pi)
-			y  = 0 + 22 * math.sin((i / 100) * math.pi + math.pi)
-			track_layout.append([x, y])
-			x  = -20 + 18 * math.cos((i / 100) * math.pi + math.pi)
-			y  = 0 + 18 * math.sin((i / 100) * math.pi + math.pi)
-			track_layout.append([x, y])
-
 		self.draw_floor()
-		self.draw_race_track(track_layout)
+		self.draw_race_track(self.track_buffer)
 		self.draw_race_car(self.car_x, self.car_y, self.car_a)
 		
 		size = self.window.get_size()
@@ -205,61 +382,79 @@ class Graphics():
 
 	# Display the stats (episode, speed, time elapsed) of the simulation on the display
 	def draw_details(self, episode_no, speed, time_elapsed):
-		font = pygame.font.SysFont('arial', 16)
-
 		# Display episode number
 		text = "          Episode: " + str(round(episode_no, 0))
 		if episode_no == -1:
 			text = "   VALIDATING MODEL NOW"
-		textSurface = font.render(text, True, (255, 0, 0, 255)).convert_alpha()
-		textData = pygame.image.tostring(textSurface, "RGBA", True)
-		glWindowPos2d(220, 10)
-		glDrawPixels(textSurface.get_width(), textSurface.get_height(), GL_RGBA, GL_UNSIGNED_BYTE, textData)
+		self.draw_text(text, 220, 10)
 
 		# Display speed
-		text = "             Speed: " + str(round(speed, 1)) + " m/s"
-		textSurface = font.render(text, True, (255, 0, 0, 255)).convert_alpha()
-		textData = pygame.image.tostring(textSurface, "RGBA", True)
-		glWindowPos2d(220, 40)
-		glDrawPixels(textSurface.get_width(), textSurface.get_height(), GL_RGBA, GL_UNSIGNED_BYTE, textData)
+		self.draw_text("             Speed: " + str(round(speed, 1)) + " m/s", 220, 40)
 
 		# Display time elapsed
-		text = "   Time Elapsed: " + str(round(time_elapsed, 1)) + " s"
-		textSurface = font.render(text, True, (255, 0, 0, 255)).convert_alpha()
-		textData = pygame.image.tostring(textSurface, "RGBA", True)
-		glWindowPos2d(220, 70)
-		glDrawPixels(textSurface.get_width(), textSurface.get_height(), GL_RGBA, GL_UNSIGNED_BYTE, textData)
+		self.draw_text("   Time Elapsed: " + str(round(time_elapsed, 1)) + " s", 220, 70)
+
+	# Draws a line of text at window position (x, y). Its image is rendered again only when the text at
+	# that position changes
+	def draw_text(self, text, x, y):
+		image = self.detail_images.get((x, y))
+		if image is None or image[0] != text:
+			if self.font is None:
+				self.font = pygame.font.SysFont('arial', 16)
+			textSurface = self.font.render(text, True, (255, 0, 0, 255)).convert_alpha()
+			image = (text, textSurface.get_width(), textSurface.get_height(), pygame.image.tostring(textSurface, "RGBA", True))
+			self.detail_images[(x, y)] = image
+		_, width, height, textData = image
+		glWindowPos2d(x, y)
+		glDrawPixels(width, height, GL_RGBA, GL_UNSIGNED_BYTE, textData)
+
+	# Removes all dots of the path
+	def clear_path(self):
+		self.path_written = 0 # dots recorded since the path was cleared
+		self.path_uploaded = 0 # dots of them uploaded to the vertex buffer
+		self.path_last = None
 
-	# Draws path taken by the car (The higher the speed of the car, the further spaced the red dots)
+	# Records the current car position as a red dot of the path, unless it is closer than path_spacing to the
+	# last dot. Once the ring buffer is full the oldest dot is overwritten
+	def update_path(self):
+		x, y = self.car_x, self.car_y
+		if self.path_last is not None and math.hypot(x - self.path_last[0], y - self.path_last[1]) < self.path_spacing:
+			return
+		self.path_last = (x, y)
+		self.path[self.path_written % self.path_capacity] = (
+			(x + 0.1, y - 0.1, 0.01), (x + 0.1, y + 0.1, 0.01), (x - 0.1, y + 0.1, 0.01), (x - 0.1, y - 0.1, 0.01))
+		self.path_written += 1
+
+	# Draws path taken by the car (The higher the speed of the car, the further spaced the red dots). The dots
+	# recorded since the last call are uploaded first, then the whole path is drawn in one call
 	def draw_path(self):
+		capacity = self.path_capacity
+		pending = self.path_written - self.path_uploaded
+		if pending > 0:
+			start, end = self.path_uploaded % capacity, self.path_written % capacity
+			if pending >= capacity:
+				ranges = [(0, capacity)]
+			elif start < end:
+				ranges = [(start, end)]
+			else:
+				ranges = [(start, capacity), (0, end)]
+			glBindBuffer(GL_ARRAY_BUFFER, self.path_vbo)
+			for first, last in ranges:
+				glBufferSubData(GL_ARRAY_BUFFER, first * self.path[0].nbytes, (last - first) * self.path[0].nbytes, self.path[first:last])
+			glBindBuffer(GL_ARRAY_BUFFER, 0)
+			self.path_uploaded = self.path_written
 		glColor3f(1, 0, 0)
-		self.path.append((self.car_x + 0.1, self.car_y - 0.1 , 0.01))
-		self.path.append((self.car_x + 0.1, self.car_y + 0.1, 0.01))
-		self.path.append((self.car_x - 0.1, self.car_y + 0.1, 0.01))
-		self.path.append((self.car_x - 0.1, self.car_y - 0.1, 0.01))
-		
-		glBegin(GL_QUADS)
-		for i in range(len(self.path)):
-			glVertex3fv(self.path[i])
-		glEnd()
+		self.draw_vertex_buffer((self.path_vbo, 4 * min(self.path_written, capacity)), GL_QUADS)
 
 	# Draws the floor
 	def draw_floor(self):
 		glColor3f(1, 1, 1)
-		glBegin(GL_QUADS)
-		glVertex3fv((-100, -100, 0))
-		glVertex3fv((100, -100, 0))
-		glVertex3fv((100, 100, 0))
-		glVertex3fv((-100, 100, 0))
-		glEnd()
-
-	# Draws the race track according to the track layout
-	def draw_race_track(self, track_layout):
+		self.draw_vertex_buffer(self.floor_buffer, GL_QUADS)
+
+	# Draws the race track from the vertex buffer of its layout
+	def draw_race_track(self, track_buffer):
 		glColor3f(0.5, 0.5, 0.5)
-		glBegin(GL_QUAD_STRIP)
-		for i in range(len(track_layout)):
-			glVertex3fv((track_layout[i][0], track_layout[i][1], 0))
-		glEnd()
+		self.draw_vertex_buffer(track_buffer, GL_QUAD_STRIP)
 
 	# Draws the race car according to its current centre coordinates
 	def draw_race_car(self, x, y, a):
@@ -268,8 +463,35 @@ class Graphics():
 		glTranslatef(x, y, self.car_height/2)
 		glRotatef(a, 0, 0, 1)
 		glScalef(self.car_width/2, self.car_length/2, self.car_height/2)
+		self.draw_vertex_buffer(self.car_buffer, GL_QUADS)
+		glPopMatrix()
+
+	# Uploads an (n, 3) array of vertices to a vertex buffer object, returns the buffer and vertex count
+	def create_vertex_buffer(self, vertices):
+		vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+		vbo = glGenBuffers(1)
+		glBindBuffer(GL_ARRAY_BUFFER, vbo)
+		glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+		return vbo, len(vertices)
+
+	# Draws all vertices of a vertex buffer in a single call
+	def draw_vertex_buffer(self, vertex_buffer, mode):
+		vbo, count = vertex_buffer
+		glBindBuffer(GL_ARRAY_BUFFER, vbo)
+		glEnableClientState(GL_VERTEX_ARRAY)
+		glVertexPointer(3, GL_FLOAT, 0, None)
+		glDrawArrays(mode, 0, count)
+		glDisableClientState(GL_VERTEX_ARRAY)
+		glBindBuffer(GL_ARRAY_BUFFER, 0)
+
+	# Vertices of the floor quad, the floor rectangle of the track
+	def build_floor(self):
+		(min_x, min_y), (max_x, max_y) = self.track.floor
+		return np.array([(min_x, min_y, 0), (max_x, min_y, 0), (max_x, max_y, 0), (min_x, max_y, 0)], dtype=np.float32)
 
-		# vertices
+	# Vertices of the quads of the race car, a unit box that draw_race_car scales to the car dimensions
+	def build_race_car(self):
 		back_left_bot = (-1, -1, -1)
 		back_left_top = (-1, -1, 1)
 		back_right_bot = (1, -1, -1)
@@ -279,41 +501,17 @@ class Graphics():
 		front_right_bot = (1, 1, -1)
 		front_right_top = (1, 1, 1)
 		
-		glBegin(GL_QUADS)
-		# back surface
-		glVertex3fv(back_left_bot)
-		glVertex3fv(back_right_bot)
-		glVertex3fv(back_right_top)
-		glVertex3fv(back_left_top)
-
-		# front surface
-		glVertex3fv(front_right_bot)
-		glVertex3fv(front_left_bot)
-		glVertex3fv(front_left_top)
-		glVertex3fv(front_right_top)
-
-		# left surface
-		glVertex3fv(front_left_bot)
-		glVertex3fv(back_left_bot)
-		glVertex3fv(back_left_top)
-		glVertex3fv(front_left_top)
-
-		# right surface
-		glVertex3fv(front_right_bot)
-		glVertex3fv(front_right_top)
-		glVertex3fv(back_right_top)
-		glVertex3fv(back_right_bot)
-
-		# bot surface
-		glVertex3fv(back_left_bot)
-		glVertex3fv(front_left_bot)
-		glVertex3fv(front_right_bot)
-		glVertex3fv(back_right_bot)
-
-		# top surface
-		glVertex3fv(back_left_top)
-		glVertex3fv(back_right_top)
-		glVertex3fv(front_right_top)
-		glVertex3fv(front_left_top)
-		glEnd()
-		glPopMatrix()
\ No newline at end of file
+		return np.array([
+			# back surface
+			back_left_bot, back_right_bot, back_right_top, back_left_top,
+			# front surface
+			front_right_bot, front_left_bot, front_left_top, front_right_top,
+			# left surface
+			front_left_bot, back_left_bot, back_left_top, front_left_top,
+			# right surface
+			front_right_bot, front_right_top, back_right_top, back_right_bot,
+			# bot surface
+			back_left_bot, front_left_bot, front_right_bot, back_right_bot,
+			# top surface
+			back_left_top, back_right_top, front_right_top, front_left_top,
+		], dtype=np.float32)
\ No newline at end of file
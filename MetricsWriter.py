@@ -0,0 +1,108 @@
+import atexit
+import collections
+import csv
+import json
+import queue
+import threading
+import time
+
+# Mean of the last window values, updated in O(1) per value
+class RollingMean:
+
+    def __init__(self, window=100):
+        self.values = collections.deque(maxlen=window)
+        self.total = 0.0
+
+    def add(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+        return self.mean()
+
+    def mean(self):
+        return self.total / len(self.values) if self.values else 0.0
+
+# Writes one record per episode on a background thread, so the training loop only puts it in a queue.
+# Every sink is optional:
+#   text_path        the formatted summary line of each record
+#   csv_path         the record as a CSV row, the columns are those of the first record
+#   jsonl_path       the record as a JSON line
+#   tensorboard_dir  the numeric fields as TensorBoard scalars, needs TensorFlow
+# Files are flushed every flush_interval seconds and when the writer is closed, which also happens
+# at exit
+class MetricsWriter:
+
+    def __init__(self, text_path=None, csv_path=None, jsonl_path=None, tensorboard_dir=None, flush_interval=5.0, append=False):
+        mode = "a" if append else "w"
+        self.text_file = open(text_path, mode) if text_path else None
+        self.jsonl_file = open(jsonl_path, mode) if jsonl_path else None
+        self.csv_file = open(csv_path, mode, newline="") if csv_path else None
+        self.csv_writer = None
+        self.summary_writer = None
+        if tensorboard_dir is not None:
+            import tensorflow as tf
+            self.tf = tf
+            self.summary_writer = tf.compat.v1.summary.FileWriter(tensorboard_dir)
+        self.flush_interval = flush_interval
+        self.records_written = 0
+        self.records = queue.Queue()
+        self.closed = False
+        # A daemon thread, non-daemon threads are joined before the atexit handler could stop them
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Queues a record, a dict of JSON serialisable values, and its summary line for the text log
+    def write(self, record, line=None):
+        self.records.put((record, line))
+
+    def run(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self.records.get(timeout=max(0.0, next_flush - time.monotonic()))
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                self.write_record(*item)
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval
+        self.flush()
+
+    def write_record(self, record, line):
+        if self.text_file and line is not None:
+            self.text_file.write(line + "\n")
+        if self.jsonl_file:
+            self.jsonl_file.write(json.dumps(record) + "\n")
+        if self.csv_file:
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=list(record), extrasaction="ignore")
+                if self.csv_file.tell() == 0:
+                    self.csv_writer.writeheader()
+            self.csv_writer.writerow(record)
+        if self.summary_writer:
+            Summary = self.tf.compat.v1.Summary
+            values = [Summary.Value(tag=k, simple_value=float(v)) for k, v in record.items()
+                if isinstance(v, (int, float)) and not isinstance(v, bool)]
+            self.summary_writer.add_summary(Summary(value=values), self.records_written)
+        self.records_written += 1
+
+    def flush(self):
+        for f in (self.text_file, self.jsonl_file, self.csv_file, self.summary_writer):
+            if f:
+                f.flush()
+
+    # Writes the queued records and closes the sinks
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.records.put(None)
+        self.thread.join()
+        for f in (self.text_file, self.jsonl_file, self.csv_file, self.summary_writer):
+            if f:
+                f.close()
@@ -0,0 +1,80 @@
+import argparse
+import numpy as np
+
+# Layers of the train network built by DQN.create_network, in the order they are applied, for
+# image observations and for the feature vectors of state observations
+LAYERS = ("conv1", "conv2", "dense", "dense_1")
+MLP_LAYERS = ("dense", "dense_1", "dense_2")
+
+# Copies the weights of the train network from a TensorFlow checkpoint (a directory holding a
+# checkpoint file or a checkpoint prefix) into an .npz file. Only the export needs TensorFlow
+def export_checkpoint(checkpoint_path, npz_path):
+    import tensorflow as tf
+    reader = tf.train.load_checkpoint(checkpoint_path)
+    weights = {}
+    layers = LAYERS if reader.has_tensor("train/conv1/kernel") else MLP_LAYERS
+    for layer in layers:
+        for name in ("kernel", "bias"):
+            weights["%s/%s" % (layer, name)] = reader.get_tensor("train/%s/%s" % (layer, name)).astype(np.float32)
+    np.savez(npz_path, **weights)
+
+# Valid convolution of NHWC inputs with an HWIO kernel. The strided windows are copied into an im2col
+# matrix with one row per output pixel and multiplied with the kernel in one matmul
+def conv2d(inputs, kernel, bias, stride):
+    kernel_h, kernel_w, channels, filters = kernel.shape
+    n, h, w = inputs.shape[:3]
+    out_h, out_w = (h - kernel_h) // stride + 1, (w - kernel_w) // stride + 1
+    # (N, out_h, out_w, kernel_h, kernel_w, C) view of the windows, in the HWI order of the kernel
+    stride_n, stride_h, stride_w, stride_c = inputs.strides
+    windows = np.lib.stride_tricks.as_strided(inputs, (n, out_h, out_w, kernel_h, kernel_w, channels),
+        (stride_n, stride_h * stride, stride_w * stride, stride_h, stride_w, stride_c), writeable=False)
+    columns = windows.reshape(n * out_h * out_w, kernel_h * kernel_w * channels)
+    return (columns @ kernel.reshape(-1, filters)).reshape(n, out_h, out_w, filters) + bias
+
+# 2x2 max pooling with stride 2 and SAME padding like tf.nn.max_pool2d, so an odd last row or column
+# is pooled on its own
+def max_pool(inputs):
+    h, w = inputs.shape[1:3]
+    out = inputs[:, ::2, ::2].copy()
+    np.maximum(out[:, :, :w // 2], inputs[:, ::2, 1::2], out=out[:, :, :w // 2])
+    np.maximum(out[:, :h // 2], inputs[:, 1::2, ::2], out=out[:, :h // 2])
+    np.maximum(out[:, :h // 2, :w // 2], inputs[:, 1::2, 1::2], out=out[:, :h // 2, :w // 2])
+    return out
+
+# Forward pass of the train network in NumPy, used to play without importing TensorFlow
+class NumpyPolicy:
+
+    # npz_path is either exported by export_checkpoint or a checkpoint of CheckpointManager, which
+    # holds every variable with the train network under train/
+    def __init__(self, npz_path):
+        with np.load(npz_path) as weights:
+            self.weights = {name: weights[name] for name in weights.files}
+        if any(name.startswith("train/") for name in self.weights):
+            self.weights = {name[len("train/"):]: value for name, value in self.weights.items() if name.startswith("train/")}
+
+    # Q-values of a batch of frame stacks shaped (N, 96, 96, num_frame_stack) or of feature vectors
+    # shaped (N, state_features)
+    def q_values(self, states):
+        w = self.weights
+        net = np.asarray(states, dtype=np.float32)
+        if "conv1/kernel" not in w:
+            for layer in MLP_LAYERS[:-1]:
+                net = np.maximum(net @ w[layer + "/kernel"] + w[layer + "/bias"], 0)
+            return net @ w[MLP_LAYERS[-1] + "/kernel"] + w[MLP_LAYERS[-1] + "/bias"]
+        net = max_pool(np.maximum(conv2d(net, w["conv1/kernel"], w["conv1/bias"], 4), 0))
+        net = max_pool(np.maximum(conv2d(net, w["conv2/kernel"], w["conv2/bias"], 1), 0))
+        net = net.reshape(len(net), -1)
+        net = np.maximum(net @ w["dense/kernel"] + w["dense/bias"], 0)
+        return net @ w["dense_1/kernel"] + w["dense_1/bias"]
+
+    # Greedy action for a single frame stack, like DQN.best_action
+    def best_action(self, state):
+        return int(np.argmax(self.q_values(state[np.newaxis])[0]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', default="data/checkpoints/train24", help="Checkpoint directory or prefix to export")
+    parser.add_argument('--output', default="data/checkpoints/train24.npz", help="Path of the exported weights")
+    args = parser.parse_args()
+    export_checkpoint(args.checkpoint, args.output)
+    print("exported %s to %s" % (args.checkpoint, args.output))
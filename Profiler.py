@@ -0,0 +1,64 @@
+import time
+
+# Wall time and number of calls of one named phase
+class Phase:
+
+    def __init__(self):
+        self.total = 0.0
+        self.count = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.total += time.perf_counter() - self.start
+        self.count += 1
+
+# A phase that measures nothing, handed out by disabled profilers
+class NullPhase:
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+NULL_PHASE = NullPhase()
+
+# Aggregates the time spent in named phases of the training loop:
+#     with profiler.phase("env_step"):
+#         ...
+# A disabled profiler hands out NULL_PHASE, so instrumented code costs one method call per phase.
+# Phases may be nested under different names, the time of the inner phase is then also part of
+# the outer one. A phase must not be nested in itself
+class Profiler:
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.phases = {}
+
+    def phase(self, name):
+        if not self.enabled:
+            return NULL_PHASE
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = Phase()
+        return phase
+
+    # Starts a new aggregation period, e.g. an episode
+    def reset(self):
+        for phase in self.phases.values():
+            phase.total = 0.0
+            phase.count = 0
+
+    # Maps the phase names to (seconds, calls) since the last reset
+    def summary(self):
+        return {name: (phase.total, phase.count) for name, phase in self.phases.items()}
+
+    # One line with the milliseconds per call and number of calls of each phase
+    def format(self):
+        return " ".join("%s %.3fms x%i" % (name, 1e3 * total / max(count, 1), count)
+            for name, (total, count) in self.summary().items())
+
+# Default profiler of instrumented objects
+DISABLED = Profiler(enabled=False)
@@ -1,93 +1,139 @@
 import gym
 import math
-from Graphics import Graphics
 import numpy as np
 import math
+from Profiler import DISABLED
+from Track import load_track, DEFAULT_TRACK
 
 STATE_H = 96
 STATE_W = 96
+RENDER_BACKENDS = ('opengl', 'offscreen', 'software')
+OBSERVATIONS = ('image', 'state')
+# Distances ahead of the car along the centre line, in metres, at which the state observation
+# samples the curvature of the track
+LOOKAHEAD_DISTANCES = np.array([5, 10, 20, 40])
+# Curvatures are multiplied by the radius of the curves of the default track
+CURVATURE_SCALE = 20
+STATE_FEATURES = 7 + len(LOOKAHEAD_DISTANCES)
 
+# Creates the renderer of track (the default track when None), graphics_options are passed on to
+# its constructor. The backends are imported here so that the software backend does not need
+# pygame, OpenGL or a display. With render_cache, a dict of RenderCache options, the renderer is
+# wrapped in a RenderCache
+def create_graphics(render_backend, graphics_options=None, track=None, render_cache=None):
+    assert render_backend in RENDER_BACKENDS, "unknown render backend %s" % render_backend
+    graphics_options = graphics_options or {}
+    track = track or load_track()
+    if render_backend == 'software':
+        from SoftwareGraphics import SoftwareGraphics
+        graphics = SoftwareGraphics(track, state_size=(STATE_W, STATE_H), **graphics_options)
+    else:
+        from Graphics import Graphics
+        if render_backend == 'offscreen':
+            graphics = Graphics(track, offscreen=True, state_size=(STATE_W, STATE_H), **graphics_options)
+        else:
+            graphics = Graphics(track, **graphics_options)
+    if render_cache is not None:
+        from RenderCache import RenderCache
+        graphics = RenderCache(graphics, **render_cache)
+    return graphics
+
+# observation selects what reset and step return: 'image' renders the view of the car, 'state'
+# returns the feature vector of getStateObservation without rendering. With 'state' the renderer
+# is only created when render() is called. render_cache is passed on to create_graphics
 class RaceCarEnv(gym.Env):
     metadata = {'render.modes': ['human']}
-    def __init__(self):
+    def __init__(self, render_backend='opengl', graphics_options=None, track_path=DEFAULT_TRACK, observation='image', render_cache=None):
         super(RaceCarEnv, self).__init__() # Initialising RaceCarEnv as a child class of Gym
+        assert observation in OBSERVATIONS, "unknown observation %s" % observation
+        self.track = load_track(track_path)
+        self.hf_thickness = self.track.half_width # half of the track thickness
         self.action_space = gym.spaces.Box(np.array([-1, 0, 0]).astype(np.float32), np.array([1, 1, 1]).astype(np.float32)) # steer, gas, brake
         self.action_space.n = 5
-        self.observation_space = gym.spaces.Box(low =0, high = 255, shape = (STATE_H, STATE_W, 3), dtype = np.uint8) # x coord, y coord, heading 
+        self.observation = observation
+        if observation == 'state':
+            self.observation_space = gym.spaces.Box(low=-np.inf, high=np.inf, shape=(STATE_FEATURES,), dtype=np.float32)
+        else:
+            self.observation_space = gym.spaces.Box(low =0, high = 255, shape = (STATE_H, STATE_W, 3), dtype = np.uint8) # x coord, y coord, heading 
         self.initialize_variables()
         self.icr = 0
-        self.graphics = Graphics()
-        self.hf_thickness = self.graphics.hf_thickness # half of the track thickness
+        self.render_backend = render_backend
+        self.graphics_options = graphics_options
+        self.render_cache = render_cache
+        self.graphics = None
+        if observation == 'image':
+            self.graphics = create_graphics(render_backend, graphics_options, self.track, render_cache)
         self.episode_counter = 0
         self.validation = False
+        self.profiler = DISABLED
 
     # Attributes in this function are reset everytime reset() is called
     def initialize_variables(self):
-        self.car_heading = 0 #heading in world coordinates
+        self.pos_x, self.pos_y, self.car_heading = self.track.start_pose() #heading in world coordinates
         self.car_speed = 0 
-        self.pos_x , self.pos_y = 0, 0
         self.acceleration = 0
         self.steering = 0
         self.line_reached = False
         self.dt = 0.1
+        self.time_limit = 500
         self.virtual_wheel_heading = 0 # Virtual wheel heading is the average angle of the left and right front steering wheels
-        self.previous_xy = [0, 0]
+        self.previous_xy = [self.pos_x, self.pos_y]
         self.acceleration_gain = 1 # Gain which adjusts acceleration
         self.steering_gain = 0.1 # Gain which adjusts steering
-        self.checkpoint_passed = [False, False, False] # Stores checkpoints that have been passed
-        self.cp_reward_collected = [False, False, False] # Stores rewards that have been collected
+        self.checkpoint_passed = [False] * len(self.track.checkpoints) # Stores checkpoints that have been passed
+        self.cp_reward_collected = [False] * len(self.track.checkpoints) # Stores rewards that have been collected
         self.time_elapsed = 0
 
-    # Updates if checkpoint 1 has been passed
-    def update_checkpoint1(self):
-        if -self.hf_thickness < self.previous_xy[0] < self.hf_thickness and self.previous_xy[1] < 50:
-            if  -self.hf_thickness < self.pos_x < self.hf_thickness and self.pos_y > 50:
-                self.checkpoint_passed[0] = True
-                print ("Checkpoint 1 Reached!")
-
-    # Updates if checkpoint 2 has been passed
-    def update_checkpoint2(self):
-        if self.checkpoint_passed[0] == False:
-            return None
-        if (-40 - self.hf_thickness) < self.previous_xy[0] < (-40 + self.hf_thickness) and self.previous_xy[1] > 50:
-            if  (-40 - self.hf_thickness) < self.pos_x < (-40 + self.hf_thickness) and self.pos_y < 50:
-                self.checkpoint_passed[1] = True
-                print("Checkpoint 2 Reached!")
-
-    # Updates if checkpoint 3 has been passed
-    def update_checkpoint3(self):
-        if self.checkpoint_passed[1] == False:
-            return None
-        if (-40 - self.hf_thickness) < self.previous_xy[0] < (-40 + self.hf_thickness) and self.previous_xy[1] > 0:
-            if  (-40 - self.hf_thickness) < self.pos_x < (-40 + self.hf_thickness) and self.pos_y < 0:
-                self.checkpoint_passed[2] = True
-                print("Checkpoint 3 Reached!")
+    # Updates the checkpoints passed in this step, they have to be passed in order
+    def update_checkpoints(self):
+        for i, segment in enumerate(self.track.checkpoints):
+            if i > 0 and self.checkpoint_passed[i - 1] == False:
+                return None
+            if self.track.crosses_start(segment, self.previous_xy[0], self.previous_xy[1], self.pos_x, self.pos_y):
+                self.checkpoint_passed[i] = True
+                print ("Checkpoint %i Reached!" % (i + 1))
 
     # Resets environment
     def reset(self):
         self.initialize_variables()
-        state_image = self.graphics.reset_graphics()
+        state_image = self.graphics.reset_graphics() if self.graphics is not None else None
         self.episode_counter += 1
         if self.validation:
             self.episode_counter = -1
+        if self.observation == 'state':
+            return self.getStateObservation()
         return state_image
 
     # Moving the car 1 time step based on given action
-    def step(self, action):
-        self.time_elapsed += self.dt
-        
+    # Applies the action for repeat physics steps and renders only the last of them. The sub-steps stop
+    # at the one that ends the episode. The reward is the sum over the sub-steps that ran, info is the
+    # track state of the last one plus the number of sub-steps in "steps" and their rewards in "rewards"
+    def step(self, action, repeat=1):
+        assert repeat >= 1, "repeat must be at least 1"
         # Acceleration is computed from both the brake and acceleration values
         self.acceleration = (action[1] - action[2]) * self.acceleration_gain
         self.steering = action[0] * self.steering_gain
         
-        state = self.getNextState()
-        reward = self.getReward()
-        done = self.isDone()
-        info = "Hello World"
+        rewards = []
+        with self.profiler.phase("physics"):
+            for _ in range(repeat):
+                self.time_elapsed += self.dt
+                self.getNextState()
+                track_state = self.getTrackState()
+                rewards.append(self.getReward(track_state))
+                done = self.isDone(track_state)
+                if done:
+                    break
+        reward = sum(rewards)
+        track_state.update(steps=len(rewards), rewards=rewards)
+        info = track_state
+        if self.observation == 'state':
+            return self.getStateObservation(), reward, done, info
         
         car_heading_angle = self.car_heading * 180 / math.pi
-        state_image = self.graphics.updateGraphics(self.pos_x, self.pos_y, car_heading_angle, self.episode_counter, 
-        self.car_speed, self.time_elapsed)
+        with self.profiler.phase("render"):
+            state_image = self.graphics.updateGraphics(self.pos_x, self.pos_y, car_heading_angle, self.episode_counter, 
+            self.car_speed, self.time_elapsed)
         return state_image, reward, done, info
 
     def get_acceleration(self):
@@ -116,102 +162,127 @@ class RaceCarEnv(gym.Env):
 
         return self.pos_x, self.pos_y, self.car_heading, self.car_speed
 
+    # Evaluates the track tests once per step, after getNextState. The returned record holds
+    #   segment             index of the track segment the car is on, None when it is out of the track
+    #   lateral_offset      distance from the centre line of the nearest segment, positive to the right
+    #                       of the driving direction, None away from the track
+    #   progress            metres advanced along the segment in this step, absolute on arcs
+    #   out_of_track, crossed_finish_line, stops_moving_forward, time_limit_exceeded
+    #   termination_reason  name of the test that ends the episode, None while it continues
+    # Reward, done and info of the step are derived from it
+    def getTrackState(self):
+        self.update_checkpoints()
+        nearest, lateral_offset, _ = self.track.locate(self.pos_x, self.pos_y)
+        segment = nearest if nearest is not None and -self.hf_thickness < lateral_offset < self.hf_thickness else None
+        progress = 0
+        if segment is not None:
+            progress = self.track.segments[segment].progress(self.previous_xy[0], self.previous_xy[1], self.pos_x, self.pos_y)
+
+        track_state = {
+            "segment": segment,
+            "lateral_offset": lateral_offset,
+            "progress": progress,
+            "out_of_track": segment is None,
+            "crossed_finish_line": self.crossed_finish_line(),
+            "stops_moving_forward": self.stops_moving_forward(),
+            "time_limit_exceeded": self.time_elapsed > self.time_limit,
+        }
+        track_state["termination_reason"] = self.termination_reason(track_state)
+        return track_state
+
+    # Feature vector of the state observation: position, heading and speed of the car, its lateral
+    # offset (in half track widths) and heading error relative to the centre line, and the curvature
+    # of the centre line at LOOKAHEAD_DISTANCES ahead. The track features are 0 away from the track
+    def getStateObservation(self):
+        features = np.zeros(STATE_FEATURES, dtype=np.float32)
+        features[:5] = (self.pos_x / 100, self.pos_y / 100, math.sin(self.car_heading), math.cos(self.car_heading), self.car_speed / 10)
+        segment, lateral_offset, s = self.track.locate(self.pos_x, self.pos_y)
+        if segment is not None:
+            tx, ty = self.track.segments[segment].tangent(s)
+            heading_error = self.car_heading - math.atan2(-tx, ty)
+            features[5] = lateral_offset / self.hf_thickness
+            features[6] = (heading_error + math.pi) % (2 * math.pi) - math.pi
+            features[7:] = self.track.curvature_at(self.track.starts[segment] + s + LOOKAHEAD_DISTANCES) * CURVATURE_SCALE
+        return features
+
+    # Names the test that ends the episode, in the priority of VecRaceCarEnv.termination_reason
+    def termination_reason(self, track_state):
+        for reason in ("crossed_finish_line", "out_of_track", "time_limit_exceeded", "stops_moving_forward"):
+            if track_state[reason]:
+                return reason
+        return None
+
     # Using information from previous state and current state, reward is calculated
-    def getReward(self):
+    def getReward(self, track_state):
         reward = -0.1
-        self.update_checkpoint1()
-        self.update_checkpoint2()
-        self.update_checkpoint3()
-        reward += self.get_progress_as_reward()
+        reward += self.get_progress_as_reward(track_state)
         for i in range(len(self.cp_reward_collected)):
             if self.cp_reward_collected[i] == False:
                 if self.checkpoint_passed[i] == True:
                     reward += 1000
                     self.cp_reward_collected[i] = True  
 
-        if self.crossed_finish_line():
+        if track_state["crossed_finish_line"]:
             reward += 10000
-        if self.is_out_of_track():
+        if track_state["out_of_track"]:
             reward -= 10000
-        if self.stops_moving_forward():
+        if track_state["stops_moving_forward"]:
             reward -= 10000
         
         # If the car does not complete the track in 500 seconds, a negative reward is given
-        if self.time_elapsed > 500:
+        if track_state["time_limit_exceeded"]:
             reward -= 10000
         return reward
 
     # Rewards are given the further it travels along the track
-    def get_progress_as_reward(self):
-        reward = 0
+    def get_progress_as_reward(self, track_state):
         straight_reward_scale = 1 # Reward of 1 for every metre advanced along straight segment
         curve_reward_scale = 100 # Reward of 100 for every radian advanced along curved segment
-        if  -self.hf_thickness < self.pos_x < self.hf_thickness and 0 <= self.pos_y <= 50: # First straight segment
-            reward += (self.pos_y - self.previous_xy[1]) * straight_reward_scale
-        elif (-40 - self.hf_thickness) < self.pos_x < (-40 + self.hf_thickness) and 0 <= self.pos_y <= 50: # Second straight segment
-            reward += (self.previous_xy[1] - self.pos_y) * straight_reward_scale
-        elif self.pos_y > 50: # First curved segment
-            previous_angle = math.atan2(self.previous_xy[1] - 50, self.previous_xy[0] - (-20))
-            curr_angle = math.atan2(self.pos_y - 50, self.pos_x - (-20))
-            reward += abs(curr_angle - previous_angle) * curve_reward_scale
-        elif self.pos_y < 0: # Second curved segment
-            previous_angle = math.atan2(self.previous_xy[1] - 0, self.previous_xy[0] - (-20))
-            curr_angle = math.atan2(self.pos_y - 0, self.pos_x - (-20))
-            reward += abs(curr_angle - previous_angle) * curve_reward_scale
-        return reward
+        if track_state["segment"] is None:
+            return 0
+        radius = self.track.segments[track_state["segment"]].radius
+        if radius is None:
+            return track_state["progress"] * straight_reward_scale
+        return track_state["progress"] / radius * curve_reward_scale
 
     def stops_moving_forward(self):
         return self.car_speed < 0
 
     # Cross check if the finish line is crossed
     def crossed_finish_line(self):
-        if self.checkpoint_passed[2] == False:
+        if self.checkpoint_passed and self.checkpoint_passed[-1] == False:
             return self.line_reached
-        if self.previous_xy[0] > -self.hf_thickness and self.previous_xy[0] < self.hf_thickness: 
-            if self.pos_x > -self.hf_thickness  and self.pos_x < self.hf_thickness:
-                if self.previous_xy[1] < 0 and self.pos_y > 0:
-                    self.line_reached = True
+        if self.track.crosses_start(0, self.previous_xy[0], self.previous_xy[1], self.pos_x, self.pos_y):
+            self.line_reached = True
         return self.line_reached
 
-    # Check if the car is out of track
-    def is_out_of_track(self):
-        is_in_first_seg = (-self.hf_thickness < self.pos_x < self.hf_thickness) and 0 <= self.pos_y <= 50 
-        is_in_circle_seg = self.checkCircleSeg()
-        is_in_third_seg = ((-40 - self.hf_thickness) < self.pos_x < (-40 + self.hf_thickness)) and 0 <= self.pos_y <= 50 
-        return not (is_in_first_seg or is_in_circle_seg or is_in_third_seg)
-
-    # Helper function to check if the car is in the curved segments
-    def checkCircleSeg(self):
-        isWithinRange = False
-        if self.pos_y > 50:
-            distance = math.sqrt(math.pow(self.pos_x - (-20), 2) + math.pow(self.pos_y - 50, 2))
-            isWithinRange = (20 - self.hf_thickness) < distance < (20 + self.hf_thickness)
-        
-        if self.pos_y < 0:
-            distance = math.sqrt(math.pow(self.pos_x - (-20), 2) + math.pow(self.pos_y - 0, 2))
-            isWithinRange = (20 - self.hf_thickness) < distance < (20 + self.hf_thickness)
-        
-        return isWithinRange
-
     # Check if the episode is terminated
-    def isDone(self):
-        time_limit_exceeded = self.time_elapsed > 500
-        if time_limit_exceeded:
+    def isDone(self, track_state):
+        if track_state["time_limit_exceeded"]:
             print ("Episode done: ", "Time limit exceeded")
-        if self.is_out_of_track():
+        if track_state["out_of_track"]:
             print ("Episode done: ", "Car out of track")
-        if self.crossed_finish_line():
+        if track_state["crossed_finish_line"]:
             print ("Episode done: ", "CROSSED FINISH LINE!!!")
-        if self.stops_moving_forward():
+        if track_state["stops_moving_forward"]:
             print("Episode done: ", "Stops moving forward")
-        return time_limit_exceeded or self.is_out_of_track() or self.crossed_finish_line() or self.stops_moving_forward()
+        return track_state["termination_reason"] is not None
     
     # Render graphics
     def render(self, mode='human', close=False):
+        if self.graphics is None:
+            self.graphics = create_graphics(self.render_backend, self.graphics_options, self.track, self.render_cache)
+            self.graphics.profiler = self.profiler
         car_heading_angle = self.car_heading * 180 / math.pi
         imagedata = self.graphics.updateGraphics(self.pos_x, self.pos_y, car_heading_angle, self.episode_counter, 
         self.car_speed, self.time_elapsed)
         return imagedata
 
     def update_validation(self, validation):
-        self.validation = validation
\ No newline at end of file
+        self.validation = validation
+
+    # Times the phases of step and of the renderer with profiler
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+        if self.graphics is not None:
+            self.graphics.profiler = profiler
\ No newline at end of file
@@ -0,0 +1,80 @@
+import collections
+import math
+
+import numpy as np
+
+# Keeps the observations of recently rendered car poses. The camera of both renderers looks straight
+# down at the car from a fixed height and the stats and path are drawn after the capture, so an
+# observation depends only on the position and heading of the car. Poses are quantized to
+# position_step metres and heading_step degrees and a miss renders the centre of the pose cell, so a
+# cached observation is that of a pose up to half a step away from the exact one and its edges can be
+# off by max_displacement. Once the observations take more than max_bytes the least recently used are evicted.
+# The window of the on-screen renderer is not redrawn on hits
+class RenderCache:
+
+    def __init__(self, graphics, position_step=0.05, heading_step=0.5, max_bytes=256 * 2**20):
+        # With readback latency the renderer returns the observation of the previous pose
+        assert not getattr(graphics, "readback_latency", 0), "the render cache needs readback_latency=0"
+        assert (360 / heading_step).is_integer(), "heading_step must divide 360 degrees"
+        self.graphics = graphics
+        self.position_step = position_step
+        self.heading_step = heading_step
+        self.headings = int(360 / heading_step)
+        self.max_bytes = max_bytes
+        self.observations = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def profiler(self):
+        return self.graphics.profiler
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self.graphics.profiler = profiler
+
+    # Pose cell of a position in metres and a heading in degrees
+    def key(self, car_x, car_y, car_a):
+        return (int(round(car_x / self.position_step)), int(round(car_y / self.position_step)),
+            int(round(car_a / self.heading_step)) % self.headings)
+
+    # Largest distance in metres between a point drawn at the exact pose and at the centre of its cell,
+    # radius metres from the car centre. The camera does not turn with the car, so only the car itself
+    # is moved by the rounding of the heading
+    def max_displacement(self, radius):
+        return math.hypot(self.position_step / 2, self.position_step / 2) + math.radians(self.heading_step / 2) * radius
+
+    # Returns the observation of the pose cell of the car. It is read-only and shared by all calls
+    # that hit the same cell
+    def updateGraphics(self, car_x, car_y, car_a, episode_no, speed, time_elapsed):
+        key = self.key(car_x, car_y, car_a)
+        observation = self.observations.get(key)
+        if observation is not None:
+            self.observations.move_to_end(key)
+            self.hits += 1
+            return observation
+
+        self.misses += 1
+        cell_x, cell_y, cell_a = key
+        # The offscreen renderer returns a view of its readback buffer, which is reused
+        observation = np.array(self.graphics.updateGraphics(cell_x * self.position_step, cell_y * self.position_step,
+            cell_a * self.heading_step, episode_no, speed, time_elapsed))
+        observation.flags.writeable = False
+        self.observations[key] = observation
+        self.nbytes += observation.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self.observations.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+        return observation
+
+    # The start pose is rendered exactly by the wrapped renderer, which also resets its path
+    def reset_graphics(self):
+        return self.graphics.reset_graphics()
+
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    def clear(self):
+        self.observations.clear()
+        self.nbytes = 0
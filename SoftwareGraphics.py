@@ -0,0 +1,126 @@
+import numpy as np
+import math
+from Profiler import DISABLED
+from Track import load_track
+
+# Colours used by Graphics (glColor3f values mapped to 8-bit) and the glClear colour
+FLOOR_COLOUR = 255
+TRACK_COLOUR = 128
+CAR_COLOUR = 0
+BACKGROUND_COLOUR = 0
+
+class SoftwareGraphics():
+	# track is the Track to draw, the default track when None
+	def __init__(self, track=None, state_size=(96, 96), supersampling=3):
+		# CONSTANTS #
+		# These mirror the constants in Graphics so that both backends draw the same scene
+		self.track = track or load_track()
+		self.track_thickness = self.track.width
+		self.hf_thickness = self.track_thickness/2 #half track thickness
+		self.car_length = 2
+		self.car_width = 1
+		self.car_height = 1
+		self.camera_height = 50
+		self.camera_vertical_fov = 45 # field of view
+		self.state_size = state_size
+		self.supersampling = supersampling # samples per pixel along each axis, averaged like cv2.INTER_AREA
+		# VARIABLES #
+		self.car_x = 0
+		self.car_y = 0
+		self.car_a = 0
+		self.profiler = DISABLED
+
+		# The camera always looks straight down at the car, so the floor offset of every
+		# sample relative to the car is constant and can be computed once
+		half_extent = self.camera_height * math.tan(math.radians(self.camera_vertical_fov / 2))
+		w, h = state_size
+		ss = supersampling
+		offsets_x = (((np.arange(w * ss) + 0.5) / (w * ss) * 2 - 1) * half_extent * (w / h)).astype(np.float32)
+		offsets_y = (((np.arange(h * ss) + 0.5) / (h * ss) * 2 - 1) * half_extent).astype(np.float32)
+		# Image rows follow world x and columns follow world y, matching the array
+		# layout Graphics returns after pygame.surfarray.array3d
+		self.offset_x, self.offset_y = np.meshgrid(offsets_x, offsets_y, indexing='ij')
+		# The top of the car is closer to the camera, so it covers a slightly larger area of the image
+		top_scale = (self.camera_height - self.car_height) / self.camera_height
+		self.car_offset_x = self.offset_x * top_scale
+		self.car_offset_y = self.offset_y * top_scale
+		# The samples form a regular grid, so the samples near a track segment are a block of rows and columns
+		self.offsets_x, self.offsets_y = offsets_x, offsets_y
+		self.samples = np.empty(self.offset_x.shape, dtype=np.float32)
+		self.image = np.empty(state_size + (3,), dtype=np.uint8)
+		self.batch = np.empty((0,) + self.image.shape, dtype=np.uint8)
+
+	# RaceCarEnv calls this function to update the graphics every time step
+	def updateGraphics(self, car_x, car_y, car_a, episode_no, speed, time_elapsed):
+		self.car_x = car_x
+		self.car_y = car_y
+		self.car_a = car_a
+		self.draw_view(car_x, car_y, car_a, self.image)
+		return self.image.copy()
+
+	# Draws the observation of a car pose into image, a (w, h, 3) uint8 array
+	def draw_view(self, car_x, car_y, car_a, image):
+		# The environment passes float64 positions, which would promote all samples to float64
+		x = self.offset_x + np.float32(car_x)
+		y = self.offset_y + np.float32(car_y)
+
+		# Drawing floor, track and car
+		samples = self.samples
+		with self.profiler.phase("draw"):
+			samples.fill(BACKGROUND_COLOUR)
+			samples[self.draw_floor(x, y)] = FLOOR_COLOUR
+			samples[self.draw_race_track(x, y, car_x, car_y)] = TRACK_COLOUR
+			samples[self.draw_race_car(car_a)] = CAR_COLOUR
+
+		# Average the supersamples down to the observation resolution
+		with self.profiler.phase("readback"):
+			w, h = self.state_size
+			ss = self.supersampling
+			pixels = samples.reshape(w, ss, h, ss).mean(axis=(1, 3))
+			image[...] = np.rint(pixels)[..., np.newaxis]
+
+	# Draws the observations of N cars, given as arrays of their poses, like Graphics.updateGraphicsBatch.
+	# Returns an (N, w, h, 3) array that is reused by the next call
+	def updateGraphicsBatch(self, car_x, car_y, car_a):
+		num_views = len(car_x)
+		if num_views > len(self.batch):
+			self.batch = np.empty((num_views,) + self.image.shape, dtype=np.uint8)
+		for i in range(num_views):
+			self.draw_view(car_x[i], car_y[i], car_a[i], self.batch[i])
+		return self.batch[:num_views]
+
+	# Resets the graphics to the initial state
+	def reset_graphics(self):
+		self.car_x, self.car_y, heading = self.track.start_pose()
+		self.car_a = heading * 180 / math.pi
+		state_image = self.updateGraphics(self.car_x, self.car_y, self.car_a, 0, 0, 0)
+		return state_image
+
+	# Mask of samples covered by the floor
+	def draw_floor(self, x, y):
+		(min_x, min_y), (max_x, max_y) = self.track.floor
+		return (min_x <= x) & (x <= max_x) & (min_y <= y) & (y <= max_y)
+
+	# Mask of samples covered by the race track. Only the segments near the view around the car are
+	# tested, each on the block of samples within its bounds
+	def draw_race_track(self, x, y, car_x, car_y):
+		columns_x = self.offsets_x + np.float32(car_x)
+		rows_y = self.offsets_y + np.float32(car_y)
+		# A little more than half the track width, so rounding cannot leave out covered samples
+		margin = self.hf_thickness + 0.01
+		mask = np.zeros(x.shape, dtype=bool)
+		for index in self.track.segments_near(columns_x[0], rows_y[0], columns_x[-1], rows_y[-1]):
+			min_x, min_y, max_x, max_y = self.track.segment_bounds[index]
+			i0, i1 = np.searchsorted(columns_x, min_x - margin), np.searchsorted(columns_x, max_x + margin, side='right')
+			j0, j1 = np.searchsorted(rows_y, min_y - margin), np.searchsorted(rows_y, max_y + margin, side='right')
+			if i0 < i1 and j0 < j1:
+				mask[i0:i1, j0:j1] |= self.track.segments[index].mask(x[i0:i1, j0:j1], y[i0:i1, j0:j1], self.hf_thickness)
+		return mask
+
+	# Mask of samples covered by the top of the race car, which is centred in the view
+	def draw_race_car(self, a):
+		a = math.radians(a)
+		cos_a, sin_a = math.cos(a), math.sin(a)
+		local_x = self.car_offset_x * cos_a + self.car_offset_y * sin_a
+		local_y = -self.car_offset_x * sin_a + self.car_offset_y * cos_a
+		return (np.abs(local_x) <= self.car_width/2) & (np.abs(local_y) <= self.car_length/2)
@@ -0,0 +1,271 @@
+import json
+import math
+import os
+import numpy as np
+
+DEFAULT_TRACK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tracks", "oval.json")
+
+# A straight piece of the centre line from start to end. Positions along it are measured from
+# start, lateral offsets to the right of the driving direction. Its ends are rounded, so the track
+# has no gaps on the outside of the bends between line segments
+class LineSegment:
+    radius = None
+
+    def __init__(self, start, end):
+        self.start = (float(start[0]), float(start[1]))
+        self.end = (float(end[0]), float(end[1]))
+        self.length = math.hypot(self.end[0] - self.start[0], self.end[1] - self.start[1])
+        self.start_tangent = ((self.end[0] - self.start[0]) / self.length, (self.end[1] - self.start[1]) / self.length)
+        self.end_tangent = self.start_tangent
+
+    # Position along the segment of the point nearest to (x, y) and the lateral offset of (x, y).
+    # Beyond the ends the offset is the distance from the nearest end with the sign of the side
+    def project(self, x, y):
+        (ax, ay), (tx, ty) = self.start, self.start_tangent
+        s = (x - ax) * tx + (y - ay) * ty
+        offset = (x - ax) * ty - (y - ay) * tx
+        if 0 <= s <= self.length:
+            return s, offset
+        ex, ey = self.start if s < 0 else self.end
+        return min(max(s, 0.0), self.length), math.copysign(math.hypot(x - ex, y - ey), offset)
+
+    # Driving direction at position s
+    def tangent(self, s):
+        return self.start_tangent
+
+    # Metres advanced along the segment from (px, py) to (x, y)
+    def progress(self, px, py, x, y):
+        tx, ty = self.start_tangent
+        return (x - px) * tx + (y - py) * ty
+
+    # Mask of the points of the arrays x, y that lie within half_width of the segment
+    def mask(self, x, y, half_width):
+        (ax, ay), (tx, ty) = self.start, self.start_tangent
+        dx, dy = x - np.float32(ax), y - np.float32(ay)
+        s = dx * np.float32(tx) + dy * np.float32(ty)
+        offset = dx * np.float32(ty) - dy * np.float32(tx)
+        ex, ey = x - np.float32(self.end[0]), y - np.float32(self.end[1])
+        return (((s >= 0) & (s <= self.length) & (np.abs(offset) <= half_width))
+            | (dx * dx + dy * dy <= half_width * half_width) | (ex * ex + ey * ey <= half_width * half_width))
+
+    # Points of the centre line drawn for the segment
+    def sample(self):
+        return np.array([self.start])
+
+    def bounds(self):
+        return min(self.start[0], self.end[0]), min(self.start[1], self.end[1]), max(self.start[0], self.end[0]), max(self.start[1], self.end[1])
+
+# A circular piece of the centre line, from start_angle (degrees, counterclockwise from the x axis)
+# through sweep degrees, counterclockwise for a positive sweep. steps is the number of quads it is
+# drawn with
+class ArcSegment:
+
+    def __init__(self, centre, radius, start_angle, sweep, steps=None):
+        self.centre = (float(centre[0]), float(centre[1]))
+        self.radius = float(radius)
+        self.start_angle = math.radians(start_angle)
+        self.sweep = math.radians(sweep)
+        self.direction = 1 if sweep > 0 else -1
+        self.length = abs(self.sweep) * self.radius
+        self.steps = steps or max(1, int(math.ceil(abs(sweep) / 180 * 100)))
+        cos_a, sin_a = math.cos(self.start_angle), math.sin(self.start_angle)
+        self.start = (self.centre[0] + self.radius * cos_a, self.centre[1] + self.radius * sin_a)
+        self.start_tangent = (-sin_a * self.direction, cos_a * self.direction)
+        end_angle = self.start_angle + self.sweep
+        self.end = (self.centre[0] + self.radius * math.cos(end_angle), self.centre[1] + self.radius * math.sin(end_angle))
+        self.end_tangent = (-math.sin(end_angle) * self.direction, math.cos(end_angle) * self.direction)
+
+    # None when (x, y) lies outside the sweep of the arc
+    def project(self, x, y):
+        dx, dy = x - self.centre[0], y - self.centre[1]
+        angle = (math.atan2(dy, dx) - self.start_angle) * self.direction % (2 * math.pi)
+        if angle > abs(self.sweep):
+            return None
+        # The right of the driving direction is outwards on counterclockwise arcs
+        return angle * self.radius, (math.hypot(dx, dy) - self.radius) * self.direction
+
+    def tangent(self, s):
+        angle = self.start_angle + s / self.radius * self.direction
+        return -math.sin(angle) * self.direction, math.cos(angle) * self.direction
+
+    # Arcs count the absolute change of the angle around their centre, as the reward always did. The
+    # change is wrapped into (-pi, pi], so a step across the angle of pi does not count a whole turn
+    def progress(self, px, py, x, y):
+        cx, cy = self.centre
+        change = math.atan2(y - cy, x - cx) - math.atan2(py - cy, px - cx)
+        return abs(math.pi - (math.pi - change) % (2 * math.pi)) * self.radius
+
+    def mask(self, x, y, half_width):
+        dx, dy = x - np.float32(self.centre[0]), y - np.float32(self.centre[1])
+        in_ring = np.abs(np.hypot(dx, dy) - np.float32(self.radius)) <= half_width
+        # Points between the start and end rays, without an arctangent per point
+        start_x, start_y = math.cos(self.start_angle), math.sin(self.start_angle)
+        end_x, end_y = math.cos(self.start_angle + self.sweep), math.sin(self.start_angle + self.sweep)
+        after_start = (np.float32(start_x) * dy - np.float32(start_y) * dx) * self.direction >= 0
+        before_end = (dx * np.float32(end_y) - dy * np.float32(end_x)) * self.direction >= 0
+        in_sweep = (after_start & before_end) if abs(self.sweep) <= math.pi else (after_start | before_end)
+        return in_ring & in_sweep
+
+    def sample(self):
+        angles = np.arange(self.steps + 1) / self.steps * self.sweep
+        return np.stack([self.centre[0] + self.radius * np.cos(angles + self.start_angle),
+            self.centre[1] + self.radius * np.sin(angles + self.start_angle)], axis=1)
+
+    def bounds(self):
+        points = self.sample()
+        # The chords of the samples cut slightly inside the circle
+        sagitta = self.radius * (1 - math.cos(abs(self.sweep) / self.steps / 2))
+        return points[:, 0].min() - sagitta, points[:, 1].min() - sagitta, points[:, 0].max() + sagitta, points[:, 1].max() + sagitta
+
+# Centripetal Catmull-Rom spline through points, returned as resolution metres long line segments
+def spline_segments(points, resolution=2.0, closed=False):
+    points = np.asarray(points, dtype=np.float64)
+    padded = np.concatenate([points[-1:], points, points[:2]]) if closed else np.concatenate([2 * points[:1] - points[1:2], points, 2 * points[-1:] - points[-2:-1]])
+    segments = []
+    for i in range(len(points) - (0 if closed else 1)):
+        p0, p1, p2, p3 = padded[i:i + 4]
+        t0 = 0.0
+        t1 = t0 + np.linalg.norm(p1 - p0) ** 0.5
+        t2 = t1 + np.linalg.norm(p2 - p1) ** 0.5
+        t3 = t2 + np.linalg.norm(p3 - p2) ** 0.5
+        steps = max(1, int(math.ceil(np.linalg.norm(p2 - p1) / resolution)))
+        t = np.linspace(t1, t2, steps + 1)[:, np.newaxis]
+        a1 = (t1 - t) / (t1 - t0) * p0 + (t - t0) / (t1 - t0) * p1
+        a2 = (t2 - t) / (t2 - t1) * p1 + (t - t1) / (t2 - t1) * p2
+        a3 = (t3 - t) / (t3 - t2) * p2 + (t - t2) / (t3 - t2) * p3
+        b1 = (t2 - t) / (t2 - t0) * a1 + (t - t0) / (t2 - t0) * a2
+        b2 = (t3 - t) / (t3 - t1) * a2 + (t - t1) / (t3 - t1) * a3
+        curve = (t2 - t) / (t2 - t1) * b1 + (t - t1) / (t2 - t1) * b2
+        segments += [LineSegment(a, b) for a, b in zip(curve[:-1], curve[1:])]
+    return segments
+
+# A closed circuit of segments with a constant width. The car starts at the start of the first
+# segment, which is also the finish line, and has to pass the starts of the checkpoint segments in
+# order. A uniform grid of cell_size metres lists the segments near each cell, so locating a
+# point only looks at a few segments however long the circuit is
+class Track:
+
+    def __init__(self, segments, width, checkpoints=(), floor=None, cell_size=None):
+        self.segments = segments
+        self.width = width
+        self.half_width = width / 2
+        self.checkpoints = list(checkpoints)
+        self.length = sum(segment.length for segment in segments)
+        # Distance of the start of every segment from the start line
+        self.starts = np.cumsum([0.0] + [segment.length for segment in segments[:-1]])
+        # Signed curvature of every segment, positive in left turns. Line segments of polylines and
+        # splines take the turn at their start, spread over their length
+        self.curvatures = np.empty(len(segments))
+        for i, segment in enumerate(segments):
+            if segment.radius is not None:
+                self.curvatures[i] = segment.direction / segment.radius
+            else:
+                (tx, ty), (px, py) = segment.start_tangent, segments[i - 1].end_tangent
+                self.curvatures[i] = math.atan2(px * ty - py * tx, px * tx + py * ty) / segment.length
+
+        # Bounds of every segment as rows of min x, min y, max x, max y and of the whole track
+        self.segment_bounds = bounds = np.array([segment.bounds() for segment in segments])
+        self.bounds = tuple(float(v) for v in np.concatenate([bounds[:, :2].min(axis=0), bounds[:, 2:].max(axis=0)]))
+        if floor is None:
+            floor = ((self.bounds[0] - 50, self.bounds[1] - 50), (self.bounds[2] + 50, self.bounds[3] + 50))
+        self.floor = floor
+
+        # Segments are listed in every cell their bounds widened by the track width touch, so
+        # a cell knows all segments a point in it can be on
+        self.cell_size = cell_size or width
+        self.grid = {}
+        for index, (min_x, min_y, max_x, max_y) in enumerate(bounds):
+            min_i, min_j = self.cell(min_x - width, min_y - width)
+            max_i, max_j = self.cell(max_x + width, max_y + width)
+            for i in range(min_i, max_i + 1):
+                for j in range(min_j, max_j + 1):
+                    self.grid.setdefault((i, j), []).append(index)
+
+    def cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    # Index of the nearest segment alongside (x, y), the lateral offset from its centre line and the
+    # position along the segment, (None, None, None) when no segment is within the track width
+    def locate(self, x, y):
+        nearest, nearest_offset, nearest_s = None, None, None
+        for index in self.grid.get(self.cell(x, y), ()):
+            projection = self.segments[index].project(x, y)
+            if projection is not None and (nearest is None or abs(projection[1]) < abs(nearest_offset)):
+                nearest, (nearest_s, nearest_offset) = index, projection
+        return nearest, nearest_offset, nearest_s
+
+    # Curvature of the centre line distance metres after the start line, wrapping around the circuit
+    def curvature_at(self, distance):
+        return self.curvatures[np.searchsorted(self.starts, distance % self.length, side='right') - 1]
+
+    # Indices of the segments near the rectangle between (min_x, min_y) and (max_x, max_y)
+    def segments_near(self, min_x, min_y, max_x, max_y):
+        min_i, min_j = self.cell(min_x, min_y)
+        max_i, max_j = self.cell(max_x, max_y)
+        indices = set()
+        for i in range(min_i, max_i + 1):
+            for j in range(min_j, max_j + 1):
+                indices.update(self.grid.get((i, j), ()))
+        return sorted(indices)
+
+    # Whether the move from (px, py) to (x, y) crosses the start of a segment in the driving
+    # direction, with both positions less than half the track width from its centre line
+    def crosses_start(self, index, px, py, x, y):
+        (ax, ay), (tx, ty) = self.segments[index].start, self.segments[index].start_tangent
+        hf = self.half_width
+        before = (px - ax) * tx + (py - ay) * ty < 0 and -hf < (px - ax) * ty - (py - ay) * tx < hf
+        after = (x - ax) * tx + (y - ay) * ty > 0 and -hf < (x - ax) * ty - (y - ay) * tx < hf
+        return before and after
+
+    # Position and heading (radians, counterclockwise from the y axis like RaceCarEnv.car_heading) of the start
+    def start_pose(self):
+        (x, y), (tx, ty) = self.segments[0].start, self.segments[0].start_tangent
+        return x, y, math.atan2(-tx, ty)
+
+    # Vertices of the track as a quad strip of (right, left) edge pairs along the centre line,
+    # half_width from it
+    def quad_strip(self, half_width=None):
+        half_width = self.half_width if half_width is None else half_width
+        vertices = []
+        for i, segment in enumerate(self.segments + self.segments[:1]):
+            points = segment.sample()
+            if segment.radius is None:
+                # Halfway between the directions of the previous and this segment at the joint
+                (tx, ty), (px, py) = segment.start_tangent, self.segments[i - 1].end_tangent
+                normals = np.array([[ty + py, -tx - px]]) / math.hypot(ty + py, tx + px)
+            else:
+                normals = (points - segment.centre) / segment.radius * segment.direction
+            for edge in (points + half_width * normals, points - half_width * normals):
+                vertices.append(edge)
+        strip = np.zeros((sum(len(v) for v in vertices), 3), dtype=np.float32)
+        offset = 0
+        for right, left in zip(vertices[0::2], vertices[1::2]):
+            strip[offset:offset + 2 * len(right):2, :2] = right
+            strip[offset + 1:offset + 2 * len(right):2, :2] = left
+            offset += 2 * len(right)
+        return strip
+
+# Reads a track file: a JSON object with the width of the track, the segments of its centre line
+# and optionally the indices of the checkpoint segments and the floor rectangle. Segments are
+#   {"type": "line", "start": [x, y], "end": [x, y]}
+#   {"type": "arc", "centre": [x, y], "radius": r, "start_angle": degrees, "sweep": degrees}
+#   {"type": "polyline", "points": [[x, y], ...]}
+#   {"type": "spline", "points": [[x, y], ...], "resolution": metres, "closed": false}
+# Polylines and splines are expanded into line segments, checkpoints index the expanded list
+def load_track(path=DEFAULT_TRACK):
+    with open(path) as f:
+        config = json.load(f)
+    segments = []
+    for segment in config["segments"]:
+        kind = segment["type"]
+        if kind == "line":
+            segments.append(LineSegment(segment["start"], segment["end"]))
+        elif kind == "arc":
+            segments.append(ArcSegment(segment["centre"], segment["radius"], segment["start_angle"], segment["sweep"], segment.get("steps")))
+        elif kind == "polyline":
+            segments += [LineSegment(a, b) for a, b in zip(segment["points"][:-1], segment["points"][1:])]
+        elif kind == "spline":
+            segments += spline_segments(segment["points"], segment.get("resolution", 2.0), segment.get("closed", False))
+        else:
+            raise ValueError("unknown segment type %s in %s" % (kind, path))
+    return Track(segments, config["width"], config.get("checkpoints", ()), config.get("floor"), config.get("cell_size"))
@@ -0,0 +1,164 @@
+import gym
+import math
+import numpy as np
+from RaceCarEnv import create_graphics, STATE_H, STATE_W
+from Track import load_track, DEFAULT_TRACK
+
+# Steps N cars at once on a track like RaceCarEnv. All per-car state is kept in arrays of
+# shape (N,) so physics and rewards are a handful of vectorised operations per step instead
+# of N Python-level env.step calls. The track queries go through the grid of Track once per car
+class VecRaceCarEnv():
+    metadata = {'render.modes': ['human']}
+    def __init__(self, num_envs=16, render_backend='software', graphics_options=None, track_path=DEFAULT_TRACK):
+        self.num_envs = num_envs
+        self.track = load_track(track_path)
+        self.action_space = gym.spaces.Box(np.array([-1, 0, 0]).astype(np.float32), np.array([1, 1, 1]).astype(np.float32)) # steer, gas, brake
+        self.action_space.n = 5
+        self.observation_space = gym.spaces.Box(low =0, high = 255, shape = (STATE_H, STATE_W, 3), dtype = np.uint8)
+        self.graphics = create_graphics(render_backend, graphics_options, self.track)
+        self.hf_thickness = self.track.half_width # half of the track thickness
+        self.dt = 0.1
+        self.acceleration_gain = 1 # Gain which adjusts acceleration
+        self.steering_gain = 0.1 # Gain which adjusts steering
+        self.time_limit = 500
+        self.episode_counter = np.zeros(num_envs, dtype=np.int64)
+        self.observations = np.zeros((num_envs, STATE_H, STATE_W, 3), dtype=np.uint8)
+
+        self.car_heading = np.zeros(num_envs) #heading in world coordinates
+        self.car_speed = np.zeros(num_envs)
+        self.pos_x = np.zeros(num_envs)
+        self.pos_y = np.zeros(num_envs)
+        self.previous_x = np.zeros(num_envs)
+        self.previous_y = np.zeros(num_envs)
+        num_checkpoints = len(self.track.checkpoints)
+        self.checkpoint_passed = np.zeros((num_envs, num_checkpoints), dtype=bool) # Stores checkpoints that have been passed
+        self.cp_reward_collected = np.zeros((num_envs, num_checkpoints), dtype=bool) # Stores rewards that have been collected
+        self.line_reached = np.zeros(num_envs, dtype=bool)
+        self.time_elapsed = np.zeros(num_envs)
+
+    # Resets the cars selected by mask (all cars by default) to the start line
+    def reset_cars(self, mask=None):
+        if mask is None:
+            mask = np.ones(self.num_envs, dtype=bool)
+        start_x, start_y, start_heading = self.track.start_pose()
+        for array, value in ((self.pos_x, start_x), (self.pos_y, start_y), (self.previous_x, start_x),
+                (self.previous_y, start_y), (self.car_heading, start_heading), (self.car_speed, 0), (self.time_elapsed, 0)):
+            array[mask] = value
+        self.checkpoint_passed[mask] = False
+        self.cp_reward_collected[mask] = False
+        self.line_reached[mask] = False
+        self.episode_counter[mask] += 1
+
+    # Resets all cars and returns their observations
+    def reset(self):
+        self.reset_cars()
+        self.render_observations(np.arange(self.num_envs))
+        return self.observations.copy()
+
+    # Moves every car 1 time step. actions has shape (N, 3). Cars that finish are reset
+    # automatically; their final observation and termination reason are returned in info
+    def step(self, actions):
+        actions = np.asarray(actions, dtype=np.float64)
+        self.time_elapsed += self.dt
+
+        acceleration = (actions[:, 1] - actions[:, 2]) * self.acceleration_gain
+        steering = actions[:, 0] * self.steering_gain
+
+        self.getNextState(acceleration, steering)
+        track_state = self.getTrackState()
+        reward = self.getReward(track_state)
+        done = track_state["time_limit_exceeded"] | track_state["out_of_track"] | self.line_reached | track_state["stops_moving_forward"]
+
+        self.render_observations(np.arange(self.num_envs))
+        info = {
+            "terminal_observation": self.observations[done].copy(),
+            "termination_reason": self.termination_reason(track_state, done),
+        }
+        if done.any():
+            self.reset_cars(done)
+            self.render_observations(np.flatnonzero(done))
+        return self.observations.copy(), reward, done, info
+
+    # Vectorised Ackermann steering update, see RaceCarEnv.getNextState
+    def getNextState(self, acceleration, steering):
+        self.previous_x[:] = self.pos_x
+        self.previous_y[:] = self.pos_y
+        self.car_speed += acceleration * self.dt
+        self.pos_y += self.car_speed * np.cos(self.car_heading) * self.dt
+        self.pos_x += -self.car_speed * np.sin(self.car_heading) * self.dt
+        # angular velocity is speed / icr with icr = 2 / tan(steering), which is zero without steering
+        angular_vel = self.car_speed * np.tan(steering) / 2
+        self.car_heading += angular_vel * self.dt
+
+    # Evaluates the track tests of RaceCarEnv.getTrackState once for every car. "segment" lists the
+    # segment each car is on, None when it is out of the track, and "progress" the metres it advanced
+    # along it, 0 out of the track
+    def getTrackState(self):
+        track = self.track
+        segments = [None] * self.num_envs
+        progress = np.zeros(self.num_envs)
+        for car in range(self.num_envs):
+            x, y = self.pos_x[car], self.pos_y[car]
+            px, py = self.previous_x[car], self.previous_y[car]
+            # Checkpoints have to be passed in order, a later one can be reached in the same step
+            passed = self.checkpoint_passed[car]
+            for i, segment in enumerate(track.checkpoints):
+                if i > 0 and not passed[i - 1]:
+                    break
+                passed[i] |= track.crosses_start(segment, px, py, x, y)
+            if passed.all() and track.crosses_start(0, px, py, x, y):
+                self.line_reached[car] = True
+
+            nearest, lateral_offset, _ = track.locate(x, y)
+            if nearest is not None and -self.hf_thickness < lateral_offset < self.hf_thickness:
+                segments[car] = nearest
+                progress[car] = track.segments[nearest].progress(px, py, x, y)
+
+        out_of_track = np.array([segment is None for segment in segments])
+        return {
+            "segment": segments,
+            "progress": progress,
+            "out_of_track": out_of_track,
+            "stops_moving_forward": self.car_speed < 0,
+            "time_limit_exceeded": self.time_elapsed > self.time_limit,
+        }
+
+    # Vectorised RaceCarEnv.getReward
+    def getReward(self, track_state):
+        reward = np.full(self.num_envs, -0.1)
+        reward += self.get_progress_as_reward(track_state)
+
+        new_checkpoints = self.checkpoint_passed & ~self.cp_reward_collected
+        reward += 1000 * new_checkpoints.sum(axis=1)
+        self.cp_reward_collected |= new_checkpoints
+
+        reward += 10000 * self.line_reached
+        reward -= 10000 * track_state["out_of_track"]
+        reward -= 10000 * track_state["stops_moving_forward"]
+        reward -= 10000 * track_state["time_limit_exceeded"]
+        return reward
+
+    # Rewards are given the further the cars travel along the track
+    def get_progress_as_reward(self, track_state):
+        straight_reward_scale = 1 # Reward of 1 for every metre advanced along straight segment
+        curve_reward_scale = 100 # Reward of 100 for every radian advanced along curved segment
+        scale = np.zeros(self.num_envs)
+        for car, segment in enumerate(track_state["segment"]):
+            if segment is not None:
+                radius = self.track.segments[segment].radius
+                scale[car] = straight_reward_scale if radius is None else curve_reward_scale / radius
+        return track_state["progress"] * scale
+
+    # Names why each finished car stopped, None for cars that are still running
+    def termination_reason(self, track_state, done):
+        reasons = np.full(self.num_envs, None, dtype=object)
+        reasons[done & track_state["stops_moving_forward"]] = "stops_moving_forward"
+        reasons[done & track_state["time_limit_exceeded"]] = "time_limit_exceeded"
+        reasons[done & track_state["out_of_track"]] = "out_of_track"
+        reasons[done & self.line_reached] = "crossed_finish_line"
+        return reasons
+
+    # Renders the observations of the selected cars into self.observations, in one pass of the renderer
+    def render_observations(self, indices):
+        car_heading_angle = self.car_heading[indices] * 180 / math.pi
+        self.observations[indices] = self.graphics.updateGraphicsBatch(self.pos_x[indices], self.pos_y[indices], car_heading_angle)
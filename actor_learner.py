@@ -0,0 +1,314 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from ExperienceReplay import ExperienceReplay
+from MetricsWriter import MetricsWriter, RollingMean
+from CheckpointManager import CheckpointManager
+from car_dqn import CarRacingDQN
+from RaceCarEnv import RaceCarEnv
+from Track import DEFAULT_TRACK
+import multiprocessing
+import numpy as np
+import tensorflow as tf
+import argparse
+import _thread
+import queue
+import time
+import os
+
+# Actor/learner training: several actor processes each drive their own headless RaceCarEnv with a
+# recent copy of the policy and write transitions into their own partition of a replay that lives in
+# shared memory. The learner (this process) trains on samples from all partitions continuously and
+# publishes its weights back to the actors
+
+# Allocates one shared ctypes buffer of the multiprocessing context ctx per array. specs maps names to
+# (shape, dtype), the returned layout maps names to (buffer, shape, dtype) and is passed to the actor
+# processes when they are started, which attach to the same buffers
+def create_shared_arrays(ctx, specs):
+    layout = {}
+    for name, (shape, dtype) in specs.items():
+        dtype = np.dtype(dtype)
+        layout[name] = (ctx.RawArray('b', max(1, int(np.prod(shape)) * dtype.itemsize)), shape, dtype.str)
+    return attach_shared_arrays(layout), layout
+
+def attach_shared_arrays(layout):
+    return {name: np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+        for name, (buffer, shape, dtype) in layout.items()}
+
+# Shapes of the shared replay: every replay cache gets a leading actor dimension, plus the number of
+# experiences each actor has published, the number it has started to write and control flags
+def shared_replay_specs(num_actors, replay_config):
+    specs = {}
+    for name, (shape, dtype, _) in ExperienceReplay.cache_specs(**replay_config).items():
+        specs[name] = ((num_actors,) + shape, dtype)
+    specs["counters"] = ((num_actors,), "int64")
+    specs["cursors"] = ((num_actors,), "int64")
+    # weights_version is odd while the learner writes the weights; stop asks the actors to finish
+    specs["control"] = ((2,), "int64")
+    return specs
+
+WEIGHTS_VERSION = 0
+STOP = 1
+
+# Replay partition of one actor, the caches are views of the shared arrays. Before an experience is
+# written, the number of experiences written including it is stored in the actor's cursor
+class PartitionReplay(ExperienceReplay):
+
+    def __init__(self, cursor, **kwargs):
+        self.cursor = cursor
+        super().__init__(**kwargs)
+
+    def add_experience(self, frame, action, done, reward):
+        self.cursor[...] = self.counter + 1
+        super().add_experience(frame, action, done, reward)
+
+def create_partition(arrays, actor_id, replay_config):
+    buffers = {name: arrays[name][actor_id] for name in ExperienceReplay.cache_specs(**replay_config)}
+    return PartitionReplay(arrays["cursors"][actor_id:actor_id + 1], buffers=buffers, **replay_config)
+
+# Learner side view of all partitions. Experience number e of an actor is in slot e % capacity. Only
+# the experiences the actors have published in counters are sampled, and only those whose slots are not
+# being rewritten: an actor that has started writing cursor experiences rewrites the slots of the
+# experiences before cursor - capacity. Experiences copied while their slot was rewritten are sampled
+# again. The frames of an experience outlive its slot, as the frame cache holds capacity + 2 *
+# num_frame_stack + 1 frames and an experience refers to the num_frame_stack frames before it
+class SharedExperienceReplay:
+
+    def __init__(self, arrays, replay_config):
+        self.arrays = arrays
+        self.capacity = replay_config["capacity"]
+        # Used to convert the stored frames, it owns no caches of its own
+        self.decoder = ExperienceReplay(capacity=0, **{k: v for k, v in replay_config.items() if k != "capacity"})
+
+    @property
+    def counter(self):
+        return int(self.arrays["counters"].sum())
+
+    # Actors and experience numbers of n experiences that are published and not being rewritten
+    def sample_numbers(self, n):
+        first = np.maximum(self.arrays["cursors"] - self.capacity, 0)
+        counts = np.maximum(self.arrays["counters"] - first, 0)
+        ends = np.cumsum(counts)
+        batchidx = np.random.randint(ends[-1], size=n)
+        actors = np.searchsorted(ends, batchidx, side="right")
+        return actors, first[actors] + batchidx - (ends[actors] - counts[actors])
+
+    def sample_mini_batch(self, n):
+        batch = None
+        pending = np.arange(n)
+        while len(pending):
+            actors, numbers = self.sample_numbers(len(pending))
+            rows = self.get_batch(actors, numbers % self.capacity)
+            if batch is None:
+                batch = rows
+            else:
+                for name, values in rows.items():
+                    batch[name][pending] = values
+            # The slots the actors started to rewrite while the rows were copied
+            torn = numbers < self.arrays["cursors"][actors] - self.capacity
+            pending = pending[torn]
+        return batch
+
+    # Gathers the experiences in the slots batchidx of the partitions of actors
+    def get_batch(self, actors, batchidx):
+        frames = self.arrays["frames"]
+        prev_frames = self.decoder.decode_frames(frames[actors[:, np.newaxis], self.arrays["prev_states"][actors, batchidx]])
+        next_frames = self.decoder.decode_frames(frames[actors[:, np.newaxis], self.arrays["next_states"][actors, batchidx]])
+        return {
+            "reward": self.arrays["rewards"][actors, batchidx],
+            "prev_state": np.moveaxis(prev_frames, 1, -1),
+            "next_state": np.moveaxis(next_frames, 1, -1),
+            "actions": self.arrays["actions"][actors, batchidx],
+            "done_mask": self.arrays["is_done"][actors, batchidx]
+        }
+
+# Copies the variables of the train network into the shared weights, guarded by the version counter
+def publish_weights(agent, arrays):
+    values = agent.session.run(agent.get_variables("train"))
+    control = arrays["control"]
+    control[WEIGHTS_VERSION] += 1
+    arrays["weights"][:] = np.concatenate([v.ravel() for v in values])
+    control[WEIGHTS_VERSION] += 1
+
+# Loads the shared weights into the train network if they changed since version, returns the loaded version
+def load_weights(agent, arrays, version):
+    control = arrays["control"]
+    start_version = int(control[WEIGHTS_VERSION])
+    if start_version == version or start_version % 2 == 1:
+        return version
+    weights = arrays["weights"].copy()
+    if int(control[WEIGHTS_VERSION]) != start_version:
+        return version
+    offset = 0
+    for variable in agent.get_variables("train"):
+        size = int(np.prod(variable.shape.as_list()))
+        variable.load(weights[offset:offset + size].reshape(variable.shape.as_list()), agent.session)
+        offset += size
+    return start_version
+
+def run_actor(actor_id, layout, replay_config, model_config, render_backend, track_path, episode_queue):
+    np.random.seed((os.getpid() * 7919 + actor_id) % 2**32)
+    arrays = attach_shared_arrays(layout)
+    env = RaceCarEnv(render_backend=render_backend, track_path=track_path)
+    replay = create_partition(arrays, actor_id, replay_config)
+    agent = CarRacingDQN(env=env, experience_replay=replay, **model_config)
+    agent.train_during_episodes = False
+    agent.build_graph()
+    # Actors run single threaded on the CPU and leave the GPU to the learner
+    config = tf.compat.v1.ConfigProto(device_count={'GPU': 0}, intra_op_parallelism_threads=1, inter_op_parallelism_threads=1)
+    agent.session = tf.compat.v1.Session(config=config)
+    agent.session.run(tf.compat.v1.global_variables_initializer())
+
+    version = -1
+    control = arrays["control"]
+    while not control[STOP]:
+        version = load_weights(agent, arrays, version)
+        # Epsilon decays with the experience collected by all actors
+        agent.global_counter = int(arrays["counters"].sum())
+        score, reward, frames, epsilon = agent.play_episode(False, False)
+        # The episode's transitions are complete, make them visible to the learner
+        arrays["counters"][actor_id] = replay.counter
+        episode_queue.put((actor_id, score, reward, frames, epsilon))
+
+    agent.session.close()
+
+def input_thread(list):
+    input("...enter to stop after current episodes\n")
+    list.append("OK")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_actors', type=int, default=4, help="Number of actor processes collecting experience")
+    parser.add_argument('--load_checkpoint',  choices=('True', 'False'), required=True, help="Flag(True, False) to check if you want to load the current model and train it")
+    parser.add_argument('--render_backend', choices=('opengl', 'offscreen', 'software'), default='software', help="Renderer of the actors, software runs headless without a display")
+    parser.add_argument('--track', default=DEFAULT_TRACK, help="Track file the actors drive on, see Track.load_track")
+    parser.add_argument('--weight_sync_steps', type=int, default=100, help="Train steps between publishing the weights to the actors")
+    parser.add_argument('--gradient_steps_per_call', type=int, default=1, help="Optimizer updates per learner session.run, each on its own mini batch")
+    parser.add_argument('--keep_checkpoints', type=int, default=5, help="Number of most recent checkpoints kept")
+    parser.add_argument('--keep_best_checkpoints', type=int, default=3, help="Number of checkpoints with the highest average 100 score kept besides the most recent ones")
+    args = parser.parse_args()
+    if args.gradient_steps_per_call < 1:
+        parser.error("--gradient_steps_per_call must be at least 1")
+    load_checkpoint = args.load_checkpoint == "True"
+
+    checkpoint_path = "data/checkpoints/train24"
+    train_episodes = 15000
+    save_freq_episodes = train_episodes/100
+    opendir = checkpoint_path + '.txt'
+    frame_skip = 3
+    model_config = dict(
+        min_epsilon=0.05,
+        max_negative_rewards=8,
+        min_experience_size=int(100),
+        num_frame_stack=frame_skip,
+        frame_skip=frame_skip,
+        train_freq=frame_skip,
+        batchsize=64,
+        epsilon_decay_steps=int(100000),
+        target_network_update_freq=int(1000),
+        gamma=0.95,
+        render=False,
+        prefetch_batches=2,
+        gradient_steps_per_call=args.gradient_steps_per_call,
+    )
+    experience_capacity = int(150000)
+    replay_config = dict(
+        num_frame_stack=frame_skip,
+        capacity=experience_capacity // args.num_actors,
+        pic_size=(96, 96),
+        frame_dtype="uint8",
+    )
+
+    ctx = multiprocessing.get_context("spawn")
+    arrays, layout = create_shared_arrays(ctx, shared_replay_specs(args.num_actors, replay_config))
+    dqn_agent = CarRacingDQN(env=None, experience_replay=SharedExperienceReplay(arrays, replay_config), **model_config)
+    dqn_agent.build_graph()
+    # The flattened weights of the train network are shared too
+    num_weights = sum(int(np.prod(v.shape.as_list())) for v in dqn_agent.get_variables("train"))
+    weight_arrays, weight_layout = create_shared_arrays(ctx, {"weights": ((num_weights,), "float32")})
+    arrays.update(weight_arrays)
+    layout.update(weight_layout)
+
+    sess = tf.compat.v1.InteractiveSession()
+    dqn_agent.session = sess
+    checkpoints = CheckpointManager(sess, checkpoint_path, tf.compat.v1.global_variables(),
+        keep_last=args.keep_checkpoints, keep_best=args.keep_best_checkpoints)
+    if load_checkpoint:
+        entry = checkpoints.latest()
+        entry = checkpoints.restore(entry) if entry else checkpoints.restore_saver_checkpoint()
+        assert entry, "checkpoint path %s not found" % checkpoint_path
+        print("loaded the checkpoint %s from %s - step %d" % (entry["path"], checkpoint_path, entry["step"]))
+        dqn_agent.global_counter = entry["step"]
+    else:
+        assert not os.path.exists(checkpoint_path), \
+            "checkpoint path already exists but load_checkpoint is false"
+        sess.run(tf.compat.v1.global_variables_initializer())
+    publish_weights(dqn_agent, arrays)
+
+    def save_checkpoint(avg_score):
+        entry = checkpoints.save(dqn_agent.global_counter, dqn_agent.episode_counter, avg_score)
+        print("saving to %s - %d" % (checkpoints.checkpoint_file(entry), dqn_agent.global_counter))
+
+    episode_queue = ctx.Queue()
+    actors = [ctx.Process(target=run_actor, args=(i, layout, replay_config, model_config, args.render_backend, args.track, episode_queue))
+        for i in range(args.num_actors)]
+    for actor in actors:
+        actor.start()
+
+    print("now training with %i actors... you can early stop with enter..." % args.num_actors)
+    stop_list = []
+    _thread.start_new_thread(input_thread, (stop_list,))
+    metrics = MetricsWriter(text_path=opendir, append=load_checkpoint)
+    score_window = RollingMean(100)
+    max_avg_score = -np.inf
+    train_steps = 0
+    steps_since_sync = 0
+    while not stop_list and dqn_agent.episode_counter < train_episodes:
+        # Record the episodes the actors finished
+        while True:
+            try:
+                actor_id, score, reward, frames, epsilon = episode_queue.get_nowait()
+            except queue.Empty:
+                break
+            dqn_agent.episode_counter += 1
+            dqn_agent.global_counter = dqn_agent.exp_history.counter
+            avg_score = score_window.add(score)
+            new_max = ''
+            if avg_score >= max_avg_score:
+                max_avg_score = avg_score
+                new_max = ' => New HighScore! <= '
+            strm = ("#> episode: %i | actor: %i | score: %.2f | total steps: %i | train steps: %i | epsilon: %.5f | average 100 score: %.2f" %
+                (dqn_agent.episode_counter, actor_id, score, dqn_agent.global_counter, train_steps, epsilon, avg_score))
+            if dqn_agent.prefetcher is not None:
+                strm += " | prefetch overlap: %.2f" % dqn_agent.prefetcher.overlap()
+            print(strm + new_max)
+            metrics.write(dict(episode=dqn_agent.episode_counter, actor=actor_id, score=float(score), reward=float(reward),
+                frames=frames, epsilon=epsilon, total_steps=dqn_agent.global_counter, train_steps=train_steps,
+                average_score=avg_score, time=time.time()), strm + new_max)
+            if dqn_agent.episode_counter % save_freq_episodes == 0 or (new_max and dqn_agent.episode_counter > 100):
+                save_checkpoint(avg_score)
+
+        if dqn_agent.exp_history.counter < dqn_agent.min_experience_size:
+            time.sleep(0.1)
+            continue
+        # Advances the global step and updates the target network inside the same session.run
+        dqn_agent.train()
+        train_steps += dqn_agent.gradient_steps_per_call
+        steps_since_sync += dqn_agent.gradient_steps_per_call
+        if steps_since_sync >= args.weight_sync_steps:
+            publish_weights(dqn_agent, arrays)
+            steps_since_sync = 0
+
+    print("done")
+    arrays["control"][STOP] = 1
+    # Drain the queue so actors blocked on putting their last episode can exit
+    while any(actor.is_alive() for actor in actors):
+        try:
+            episode_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    for actor in actors:
+        actor.join()
+    checkpoints.wait()
+    metrics.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from ExperienceReplay import ExperienceReplay
+from processimage import processimage
+from RaceCarEnv import RaceCarEnv, create_graphics
+
+# Runs the hot paths of training headless and reports steps per second and latency percentiles of each
+# as JSON, so that runs on different commits can be compared:
+#   python benchmarks/run_benchmarks.py --output before.json
+# DQN.train needs TensorFlow and is reported as skipped without it. Checks report whether renderers stay
+# within their stated error bounds, the script exits with status 1 when one of them fails
+
+BENCHMARKS = ('env_step', 'env_physics', 'update_graphics', 'update_graphics_batch', 'render_cache', 'software_vs_gl', 'process_image', 'replay', 'dqn_train')
+
+# Calls function iterations times after warmup calls and summarises the latency of each call.
+# items is the number of steps one call performs
+def measure(name, function, iterations, warmup=10, items=1, **details):
+    for _ in range(warmup):
+        function()
+    latencies = np.empty(iterations)
+    for i in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies[i] = time.perf_counter() - start
+    result = dict(name=name, iterations=iterations, items_per_call=items,
+        steps_per_sec=items * iterations / latencies.sum(), mean_ms=latencies.mean() * 1e3)
+    for q in (50, 90, 99):
+        result["p%i_ms" % q] = np.percentile(latencies, q) * 1e3
+    result["max_ms"] = latencies.max() * 1e3
+    result.update(details)
+    return result
+
+# The result of a check, passed when the measured errors are within their bounds
+def check(name, passed, **details):
+    return dict(name=name, passed=bool(passed), **details)
+
+# Throttle and steering that keep the car on the track for a while before it leaves it, so
+# episodes contain straights, curves and resets
+def driving_action(env):
+    steer = -1 if env.pos_y > 45 else 0
+    return np.array([steer, 0.5 if env.car_speed < 8 else 0, 0])
+
+def bench_env_step(args):
+    env = RaceCarEnv(render_backend=args.render_backend, graphics_options=graphics_options(args))
+    env.reset()
+    def step():
+        _, _, done, _ = env.step(driving_action(env))
+        if done:
+            env.reset()
+    return [measure("env_step", step, args.iterations, render_backend=args.render_backend)]
+
+# RaceCarEnv.step without updateGraphics: with state observations the environment creates no
+# renderer and returns the small feature vector of getStateObservation instead
+def bench_env_physics(args):
+    env = RaceCarEnv(observation='state')
+    env.reset()
+    def step():
+        _, _, done, _ = env.step(driving_action(env))
+        if done:
+            env.reset()
+    return [measure("env_physics", step, args.iterations * 10, observation='state')]
+
+def bench_update_graphics(args):
+    graphics = create_graphics(args.render_backend, graphics_options(args))
+    graphics.reset_graphics()
+    frame = [0]
+    def update():
+        # Follow the centre line of the first curve so the whole scene stays in view
+        angle = frame[0] % 360 * math.pi / 360
+        graphics.updateGraphics(-20 + 20 * math.cos(angle), 50 + 20 * math.sin(angle), angle * 180 / math.pi, 1, 10, frame[0] * 0.1)
+        frame[0] += 1
+    return [measure("update_graphics", update, args.iterations, render_backend=args.render_backend)]
+
+# The views of num_views cars on the first curve, drawn by one updateGraphicsBatch call and by as many
+# updateGraphics calls
+def bench_update_graphics_batch(args):
+    graphics = create_graphics(args.render_backend, graphics_options(args))
+    graphics.reset_graphics()
+    angles = np.linspace(0, math.pi, args.num_views)
+    car_x, car_y, car_a = -20 + 20 * np.cos(angles), 50 + 20 * np.sin(angles), angles * 180 / math.pi
+    def update():
+        for i in range(args.num_views):
+            graphics.updateGraphics(car_x[i], car_y[i], car_a[i], 1, 10, 0)
+    return [
+        measure("update_graphics_loop", update, args.iterations // 10 + 1, items=args.num_views, render_backend=args.render_backend),
+        measure("update_graphics_batch", lambda: graphics.updateGraphicsBatch(car_x, car_y, car_a), args.iterations // 10 + 1,
+            items=args.num_views, render_backend=args.render_backend),
+    ]
+
+# env_step with a render cache, followed by as many steps that compare the cached observations with
+# renders of the exact pose. The hit rate counts the timed steps only
+# Distance between the samples averaged into a pixel of an observation, in pixels
+def sample_spacing(graphics):
+    if hasattr(graphics, "supersampling"):
+        return 1 / graphics.supersampling
+    return 1 / math.sqrt(graphics.samples)
+
+# Largest error of a pixel of a cached observation. Edges move by up to max_displacement of the cache,
+# measured in pixels at the top of the car where they are largest, and rounding to the samples can flip
+# up to one more row of them. An edge crosses a pixel over at most sqrt(2) pixels and the largest
+# contrast is 255 levels, between the car and the floor
+def render_cache_error_bound(cache):
+    graphics = cache.graphics
+    radius = math.hypot(graphics.car_width, graphics.car_length) / 2
+    pixel_size = 2 * (graphics.camera_height - graphics.car_height) * math.tan(
+        math.radians(graphics.camera_vertical_fov / 2)) / graphics.state_size[1]
+    coverage = math.sqrt(2) * (cache.max_displacement(radius) / pixel_size + sample_spacing(graphics))
+    return 255 * min(coverage, 1)
+
+# Runs the environment through the render cache, then checks that the observations it returns stay
+# within render_cache_error_bound of exact renders of the same poses
+def bench_render_cache(args):
+    env = RaceCarEnv(render_backend=args.render_backend, graphics_options=graphics_options(args), render_cache={})
+    cache = env.graphics
+    env.reset()
+    errors = []
+    def step(compare=False):
+        observation, _, done, _ = env.step(driving_action(env))
+        if compare:
+            exact = cache.graphics.updateGraphics(env.pos_x, env.pos_y, env.car_heading * 180 / math.pi, 0, 0, 0)
+            errors.append(np.abs(observation.astype(np.int16) - exact))
+        if done:
+            env.reset()
+    result = measure("render_cache", step, args.iterations, render_backend=args.render_backend,
+        position_step=cache.position_step, heading_step=cache.heading_step)
+    result.update(hit_rate=cache.hit_rate(), cached_observations=len(cache.observations), cached_bytes=cache.nbytes)
+    for _ in range(args.iterations):
+        step(compare=True)
+    errors = np.array(errors)
+    bound = render_cache_error_bound(cache)
+    result.update(check(result["name"], errors.max() <= bound, max_pixel_error=int(errors.max()),
+        bound_pixel_error=bound, mean_pixel_error=float(errors.mean()), pixels_differing=float((errors > 0).mean())))
+    return [result]
+
+# The observations of SoftwareGraphics compared with those of the OpenGL renderer at random poses around
+# the track. They differ on edges only: per observation the mean error must stay within max_mean_error
+# levels and at most max_edge_fraction of the pixels may differ by more than 16 levels. Skipped when
+# the OpenGL renderer cannot open a window or draw into it, which a headless machine may not notice
+# before the first frame
+def bench_software_vs_gl(args, max_mean_error=1.0, max_edge_fraction=0.05):
+    try:
+        reference = create_graphics('opengl')
+        reference.reset_graphics()
+    except Exception as e:
+        return [dict(name="software_vs_gl", skipped="no OpenGL rendering: %s" % e)]
+    software = create_graphics('software')
+    min_x, min_y, max_x, max_y = software.track.bounds
+    rng = np.random.RandomState(0)
+    mean_errors, edge_fractions = [], []
+    for _ in range(args.iterations // 10 + 1):
+        x, y, a = rng.uniform(min_x, max_x), rng.uniform(min_y, max_y), rng.uniform(0, 360)
+        expected = np.array(reference.updateGraphics(x, y, a, 1, 0, 0)).astype(np.int16)
+        errors = np.abs(software.updateGraphics(x, y, a, 1, 0, 0) - expected).max(axis=-1)
+        mean_errors.append(errors.mean())
+        edge_fractions.append((errors > 16).mean())
+    return [check("software_vs_gl", max(mean_errors) <= max_mean_error and max(edge_fractions) <= max_edge_fraction,
+        observations=len(mean_errors), mean_pixel_error=float(np.mean(mean_errors)), max_mean_pixel_error=float(max(mean_errors)),
+        max_edge_fraction=float(max(edge_fractions)), bound_mean_pixel_error=max_mean_error, bound_edge_fraction=max_edge_fraction)]
+
+# Times process_image against the original skimage pipeline and checks that both give the same values
+# in each dtype the replay can store, on frames along the first curve of the track
+def bench_process_image(args):
+    graphics = create_graphics('software')
+    frame = graphics.updateGraphics(0, 20, 10, 1, 0, 0)
+    frames = np.repeat(frame[np.newaxis], 64, axis=0)
+    out = np.empty((64,) + frame.shape[:2], dtype=np.uint8)
+    results = [
+        measure("process_image", lambda: processimage.process_image(frame, out[0]), args.iterations * 10, dtype="uint8"),
+        measure("process_images", lambda: processimage.process_images(frames, out), args.iterations // 10 + 1, items=len(frames), dtype="uint8"),
+        measure("process_image_reference", lambda: processimage.process_image_reference(frame), args.iterations * 10),
+    ]
+    curve = np.stack([graphics.updateGraphics(-20 + 20 * math.cos(a), 50 + 20 * math.sin(a), a * 180 / math.pi, 1, 10, 0)
+        for a in np.linspace(0, math.pi, 64)])
+    reference = np.stack([processimage.process_image_reference(f) for f in curve])
+    for dtype in (np.float32, np.float16, np.uint8):
+        if dtype == np.uint8:
+            expected = np.rint((reference + 1) * 127.5).clip(0, 255).astype(dtype)
+        else:
+            expected = reference.astype(dtype)
+        single = np.empty(expected.shape, dtype=dtype)
+        for i, f in enumerate(curve):
+            processimage.process_image(f, single[i])
+        batched = np.empty(expected.shape, dtype=dtype)
+        processimage.process_images(curve, batched)
+        results.append(check("process_image_%s" % np.dtype(dtype).name, np.array_equal(expected, single) and np.array_equal(expected, batched),
+            dtype=np.dtype(dtype).name, frames=len(curve)))
+    return results
+
+def bench_replay(args):
+    results = []
+    frame = np.zeros((96, 96), dtype=np.uint8)
+    for capacity in args.capacities:
+        replay = ExperienceReplay(num_frame_stack=3, capacity=capacity, frame_dtype="uint8")
+        replay.start_new_episode(frame)
+        steps = [0]
+        def add():
+            steps[0] += 1
+            done = steps[0] % 200 == 0
+            replay.add_experience(frame, 1, done, 0.5)
+            if done:
+                replay.start_new_episode(frame)
+        results.append(measure("replay_add", add, args.iterations * 10, capacity=capacity))
+        # Sample from a full replay
+        while replay.counter < capacity:
+            add()
+        results.append(measure("replay_sample", lambda: replay.sample_mini_batch(args.batchsize), args.iterations,
+            items=args.batchsize, capacity=capacity))
+    return results
+
+def bench_dqn_train(args):
+    try:
+        import tensorflow as tf
+    except ImportError:
+        return [dict(name="dqn_train", skipped="tensorflow is not installed")]
+    from car_dqn import CarRacingDQN
+    agent = CarRacingDQN(env=None, experience_capacity=10000, num_frame_stack=3, batchsize=args.batchsize)
+    agent.build_graph()
+    config = tf.compat.v1.ConfigProto(device_count={'GPU': 0})
+    agent.session = tf.compat.v1.Session(config=config)
+    agent.session.run(tf.compat.v1.global_variables_initializer())
+    frame = np.zeros((96, 96), dtype=np.uint8)
+    agent.exp_history.start_new_episode(frame)
+    for i in range(1000):
+        agent.exp_history.add_experience(frame, i % agent.dim_actions, False, 0.5)
+    result = measure("dqn_train", agent.train, args.iterations // 10 + 1, items=args.batchsize, device="cpu")
+    agent.session.close()
+    return [result]
+
+def graphics_options(args):
+    return {'show_window': False} if args.render_backend == 'offscreen' else None
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS), help="Benchmarks to run")
+    parser.add_argument('--render_backend', choices=('offscreen', 'software'), default='software', help="Headless renderer for env_step and update_graphics, offscreen needs SDL_VIDEODRIVER=offscreen without a display")
+    parser.add_argument('--iterations', type=int, default=1000, help="Base number of timed calls per benchmark")
+    parser.add_argument('--capacities', type=int, nargs='+', default=[1000, 10000, 100000], help="Experience replay capacities")
+    parser.add_argument('--num_views', type=int, default=16, help="Cars drawn per call of update_graphics_batch")
+    parser.add_argument('--batchsize', type=int, default=64, help="Mini batch size of replay sampling and DQN.train")
+    parser.add_argument('--output', default=None, help="JSON file to write, printed when omitted")
+    args = parser.parse_args()
+
+    results = []
+    # The environment prints at the end of each episode, the report goes to stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for name in args.benchmarks:
+            for result in globals()["bench_" + name](args):
+                if "skipped" in result:
+                    line = "skipped: " + result["skipped"]
+                else:
+                    line = ""
+                    if "steps_per_sec" in result:
+                        line = "%10.1f steps/s  p50 %.3f ms  p99 %.3f ms" % (result["steps_per_sec"], result["p50_ms"], result["p99_ms"])
+                    if "passed" in result:
+                        line += ("  " if line else "") + ("check passed" if result["passed"] else "check FAILED")
+                print("%-24s %s" % (result["name"], line), file=sys.stderr)
+                results.append(result)
+
+    report = dict(
+        commit=git_commit(),
+        time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        machine=platform.machine(),
+        results=results,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    if any(result.get("passed") is False for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
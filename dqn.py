@@ -1,9 +1,15 @@
 from __future__ import generator_stop
-from ExperienceReplay import ExperienceReplay
+from ExperienceReplay import ExperienceReplay, PrioritizedExperienceReplay, TransitionReplay, FrameStack
+from BatchPrefetcher import BatchPrefetcher
+from Profiler import Profiler
 import numpy as np
-import tensorflow as tf
+import threading
+import os
 from processimage import processimage
 
+# TensorFlow is imported by the methods that build and run the graph, so an agent that plays with a
+# NumpyPolicy never loads it
+
 class DQN:
     def __init__(self,
             env,
@@ -22,21 +28,51 @@ class DQN:
             target_network_update_freq=1000,
             regularization = 1e-6,
             optimizer_params = None,
-            action_map=None
+            action_map=None,
+            frame_dtype="uint8",
+            replay_dir=None,
+            resume_replay=False,
+            prioritized_replay=False,
+            experience_replay=None,
+            prefetch_batches=0,
+            gradient_steps_per_call=1,
+            profile=False,
+            timeline_dir=None,
+            timeline_every=1000,
+            state_features=None
     ):
-        self.exp_history = ExperienceReplay(
-            num_frame_stack,
-            capacity=experience_capacity,
-            pic_size=pic_size
-        )
+        # With state_features the observations are feature vectors of that length instead of images.
+        # They are neither preprocessed nor stacked, the network is a multilayer perceptron and
+        # the replay stores whole transitions
+        self.state_features = state_features
+        # experience_replay replaces the replay the agent would create itself
+        if experience_replay is not None:
+            self.exp_history = experience_replay
+        elif state_features is not None:
+            assert not prioritized_replay and replay_dir is None, "state observations only support an in-memory uniform replay"
+            self.exp_history = TransitionReplay(experience_capacity, state_features)
+        else:
+            replay_class = PrioritizedExperienceReplay if prioritized_replay else ExperienceReplay
+            self.exp_history = replay_class(
+                num_frame_stack,
+                capacity=experience_capacity,
+                pic_size=pic_size,
+                frame_dtype=frame_dtype,
+                storage_dir=replay_dir,
+                resume=resume_replay
+            )
 
         # in playing mode we don't store the experience to agent history
         # but this cache is still needed to get the current frame stack
-        self.playing_cache = ExperienceReplay(
-            num_frame_stack,
-            capacity=num_frame_stack * 5 + 10,
-            pic_size=pic_size
-        )
+        if state_features is not None:
+            self.playing_cache = TransitionReplay(10, state_features)
+        else:
+            self.playing_cache = ExperienceReplay(
+                num_frame_stack,
+                capacity=num_frame_stack * 5 + 10,
+                pic_size=pic_size,
+                frame_dtype=frame_dtype
+            )
 
         if action_map is not None:
             self.dim_actions = len(action_map)
@@ -58,81 +94,162 @@ class DQN:
         self.min_experience_size = min_experience_size
         self.pic_size = pic_size
         self.regularization = regularization
-        # These default magic values always work with Adam
-        self.global_step = tf.Variable(0, trainable=False)
-        self.increment_global_step_op = tf.assign(self.global_step, self.global_step+1)
-        self.decayed_lr = tf.train.exponential_decay(0.001, self.global_step, 200000, 0.7, staircase=False)
-        lr = self.decayed_lr
-        # lr = 0.001
-        self.optimizer_params = optimizer_params or dict(learning_rate=lr, epsilon=1e-7)
+        self.optimizer_params = optimizer_params
 
         self.do_training = True
+        # Actor processes only collect experience, a separate learner trains on it
+        self.train_during_episodes = True
+        # With prefetch_batches > 0 mini batches are sampled on a background thread, which
+        # requires the replay to be modified only while holding replay_lock
+        self.prefetch_batches = prefetch_batches
+        self.prefetcher = None
+        self.replay_lock = threading.Lock()
+        # Optimizer updates applied by every train() call, each on its own mini batch
+        assert gradient_steps_per_call >= 1, "gradient_steps_per_call must be at least 1"
+        self.gradient_steps_per_call = gradient_steps_per_call
+        # With profile the phases of play_episode, env.step and the renderer are timed per episode.
+        # With timeline_dir every timeline_every-th train() call writes a TF timeline there that
+        # opens in chrome://tracing
+        self.profiler = Profiler(enabled=profile)
+        if profile and env is not None:
+            env.set_profiler(self.profiler)
+        self.timeline_dir = timeline_dir
+        self.timeline_every = timeline_every
+        self.train_calls = 0
         self.playing_epsilon = 0.0
         self.session = None
 
         self.state_size = (self.num_frame_stack,) + self.pic_size
+        # Shape of one processed observation and of one network input without the batch dimension
+        if state_features is not None:
+            self.observation_shape = self.input_shape = (state_features,)
+        else:
+            self.observation_shape = self.pic_size
+            self.input_shape = (self.pic_size[0], self.pic_size[1], self.num_frame_stack)
         self.global_counter = 0
         self.episode_counter = 0
+        # A NumpyPolicy picks the greedy actions instead of the graph when it is set
+        self.policy = None
+        # The current state of play_episode, updated in place with every frame
+        self.frame_stack = FrameStack(self.observation_shape, None if state_features is not None else num_frame_stack)
+        # Callable of the best action fetch and the session it was made for, remade by act() when the
+        # agent is given another session
+        self.act_function = None
+        self.act_session = None
 
     def build_graph(self):
-        input_dim_general = (None, self.pic_size[0], self.pic_size[1], self.num_frame_stack)   # (None, 4, 96, 96) changed to (None, 96, 96, 4)
-        input_dim_with_batch = (self.batchsize, self.pic_size[0], self.pic_size[1], self.num_frame_stack) #Input dimensions: (64, 4, 96, 96) changed to (64, 96, 96, 4)
+        import tensorflow as tf
+
+        # These default magic values always work with Adam
+        self.global_step = tf.Variable(0, trainable=False)
+        self.decayed_lr = tf.train.exponential_decay(0.001, self.global_step, 200000, 0.7, staircase=False)
+        lr = self.decayed_lr
+        # lr = 0.001
+        self.optimizer_params = self.optimizer_params or dict(learning_rate=lr, epsilon=1e-7)
 
+        input_dim_general = (None,) + self.input_shape   # (None, 4, 96, 96) changed to (None, 96, 96, 4)
         self.input_prev_state = tf.compat.v1.placeholder(tf.float32, input_dim_general, "prev_state")
-        self.input_next_state = tf.compat.v1.placeholder(tf.float32, input_dim_with_batch, "next_state")
-        self.input_reward = tf.compat.v1.placeholder(tf.float32, self.batchsize, "reward")
-        self.input_actions = tf.compat.v1.placeholder(tf.int32, self.batchsize, "actions")
-        self.input_done_mask = tf.compat.v1.placeholder(tf.int32, self.batchsize, "done_mask")
-
-        # The target Q-values come from the fixed network
-        with tf.compat.v1.variable_scope("fixed"): #64 96 96 3
-            # Create target network which is gonna be fixed and updated every C parameters
-            qsa_targets = self.create_network(self.input_next_state, trainable=False)
-
-        with tf.compat.v1.variable_scope("train"): # ? 96 96 3
-            # Create Prediction/Estimate network which will be trained/updated every 3 frames
+
+        # Create Prediction/Estimate network, the one act() runs and train() updates. Resource variables
+        # read their value where the read is placed in the graph, which the fused train step below relies on
+        with tf.compat.v1.variable_scope("train", use_resource=True): # ? 96 96 3
             qsa_estimates = self.create_network(self.input_prev_state, trainable=True)
 
         self.best_action = tf.argmax(qsa_estimates, axis=1)
 
-        not_done = tf.cast(tf.logical_not(tf.cast(self.input_done_mask, "bool")), "float32")
-        # select the chosen action from each row
-        # in numpy this is qsa_estimates[range(batchsize), self.input_actions]
-        action_slice = tf.stack([tf.range(0, self.batchsize), self.input_actions], axis=1)
-        q_estimates_for_input_action = tf.gather_nd(qsa_estimates, action_slice)
-
-        #Taken from paper : Loss = [(r + gamma*max Qtarget)-(Q estimate)^2]
-        q_target = tf.reduce_max(qsa_targets, -1) * self.gamma * not_done + self.input_reward
-        training_loss = tf.nn.l2_loss(q_target - q_estimates_for_input_action) / self.batchsize
-
-        # reg_loss = tf.add_n(tf.losses.get_regularization_losses())
-        reg_loss = [0]
-
         #Adam optimizer
         optimizer = tf.train.AdamOptimizer(**(self.optimizer_params))
         #Adadelta optimizer:
         # optimizer = tf.train.RMSPropOptimizer(**(self.optimizer_params))
 
-        self.train_op = optimizer.minimize(reg_loss + training_loss)
+        self.build_fused_train_step(optimizer)
+
+    # Builds the ops train() and play_episode run once per step. step_op increments the global step and
+    # copies the train network to the fixed network whenever the new global step is a multiple of
+    # target_network_update_freq. fused_train_op computes the targets of all gradient_steps_per_call mini
+    # batches stacked in the fused inputs with the fixed network, then increments and syncs like step_op,
+    # once, and runs an optimizer update per mini batch. The global step so advances once per environment
+    # step whatever gradient_steps_per_call is, which keeps the learning rate decay and the target network
+    # updates on the same schedule. Every gradient step builds its own copy of the train network
+    # under a control dependency on the previous update, so it reads the weights that update left behind
+    def build_fused_train_step(self, optimizer):
+        import tensorflow as tf
+        n = self.batchsize * self.gradient_steps_per_call
+        input_dim = (n,) + self.input_shape
+        self.fused_prev_state = tf.compat.v1.placeholder(tf.float32, input_dim, "fused_prev_state")
+        self.fused_next_state = tf.compat.v1.placeholder(tf.float32, input_dim, "fused_next_state")
+        self.fused_reward = tf.compat.v1.placeholder(tf.float32, n, "fused_reward")
+        self.fused_actions = tf.compat.v1.placeholder(tf.int32, n, "fused_actions")
+        self.fused_done_mask = tf.compat.v1.placeholder(tf.int32, n, "fused_done_mask")
+        # Importance sampling weights of prioritized replay, uniform sampling leaves them at 1
+        self.fused_weights = tf.compat.v1.placeholder_with_default(tf.ones(n), n, "fused_weights")
+
+        # Create target network which is gonna be fixed and updated every C parameters. Its weights are
+        # read before the sync of this call, which takes effect from the next one
+        with tf.compat.v1.variable_scope("fixed", use_resource=True): #64 96 96 3
+            qsa_targets = self.create_network(self.fused_next_state, trainable=False)
 
         train_params = self.get_variables("train")
         fixed_params = self.get_variables("fixed")
-
         assert (len(train_params) == len(fixed_params))
-        self.copy_network_ops = [tf.assign(fixed_v, train_v) for train_v, fixed_v in zip(train_params, fixed_params)]
+
+        def increment_and_sync():
+            step = tf.compat.v1.assign_add(self.global_step, 1)
+            copy_network = lambda: tf.group(*[tf.compat.v1.assign(fixed_v, train_v) for train_v, fixed_v in zip(train_params, fixed_params)])
+            return tf.cond(tf.equal(step % self.target_network_update_freq, 0), copy_network, tf.no_op)
+
+        self.step_op = increment_and_sync()
+
+        with tf.control_dependencies([qsa_targets]):
+            update = increment_and_sync()
+        td_errors = []
+        for i in range(self.gradient_steps_per_call):
+            batch = slice(i * self.batchsize, (i + 1) * self.batchsize)
+            with tf.control_dependencies([update]):
+                with tf.compat.v1.variable_scope("train", reuse=True):
+                    qsa_estimates = self.create_network(self.fused_prev_state[batch], trainable=True)
+                step_td_errors = self.create_td_errors(qsa_estimates, qsa_targets[batch], self.fused_actions[batch],
+                    self.fused_reward[batch], self.fused_done_mask[batch])
+                loss = tf.reduce_sum(self.fused_weights[batch] * tf.square(step_td_errors)) / 2 / self.batchsize
+                update = optimizer.minimize(loss, var_list=train_params)
+            td_errors.append(step_td_errors)
+
+        self.fused_train_op = update
+        self.fused_td_errors = tf.concat(td_errors, axis=0)
+
+    def create_td_errors(self, qsa_estimates, qsa_targets, actions, reward, done_mask):
+        import tensorflow as tf
+        not_done = tf.cast(tf.logical_not(tf.cast(done_mask, "bool")), "float32")
+        # select the chosen action from each row
+        # in numpy this is qsa_estimates[range(batchsize), actions]
+        action_slice = tf.stack([tf.range(0, self.batchsize), actions], axis=1)
+        q_estimates_for_input_action = tf.gather_nd(qsa_estimates, action_slice)
+
+        #Taken from paper : Loss = [(r + gamma*max Qtarget)-(Q estimate)^2]
+        # The fixed network only changes when the train network is copied into it
+        q_target = tf.stop_gradient(tf.reduce_max(qsa_targets, -1) * self.gamma * not_done + reward)
+        return q_target - q_estimates_for_input_action
 
     def get_variables(self, scope):
+        import tensorflow as tf
         vars = [t for t in tf.compat.v1.global_variables()
             if "%s/" % scope in t.name and "Adam" not in t.name]
         return sorted(vars, key=lambda v: v.name)
 
     def create_network(self, input, trainable):
+        import tensorflow as tf
         if trainable:
             # wr = None
             wr = tf.compat.v1.keras.regularizers.l2(l=self.regularization)
         else:
             wr = None
 
+        if self.state_features is not None:
+            # Feature vectors need no convolutions
+            net = tf.layers.dense(input, 256, activation=tf.nn.relu, kernel_regularizer=wr)
+            net = tf.layers.dense(net, 256, activation=tf.nn.relu, kernel_regularizer=wr)
+            return tf.layers.dense(net, self.dim_actions, activation=None, kernel_regularizer=wr)
+
         net = tf.layers.conv2d(inputs=input, filters=8, kernel_size=(7,7), strides=4, name='conv1', kernel_regularizer=wr)
         net = tf.nn.relu(net)
         net = tf.nn.max_pool2d(net, ksize=2, strides=2, padding='SAME')
@@ -147,6 +264,13 @@ class DQN:
 
         return q_state_action_values
 
+    # Writes an observation of the environment into out, in the dtype the replay stores
+    def process_observation(self, observation, out):
+        if self.state_features is not None:
+            out[...] = observation
+        else:
+            processimage.process_image(observation, out)
+
     def check_early_stop(self, reward, totalreward, fie):
         return False, 0.0
 
@@ -163,18 +287,68 @@ class DQN:
             r = 1.0 - self.global_counter / float(self.epsilon_decay_steps)
             return self.min_epsilon + (self.initial_epsilon - self.min_epsilon) * r
 
+    # Greedy actions for a batch of states shaped (N,) + input_shape. The graph is run through a callable
+    # of the session made for this one feed and fetch, which saves session.run building them on every call
+    def act(self, states):
+        if self.policy is not None:
+            return np.argmax(self.policy.q_values(states), axis=1)
+        if self.act_session is not self.session:
+            self.act_function = self.session.make_callable(self.best_action, [self.input_prev_state])
+            self.act_session = self.session
+        return self.act_function(states)
+
+    # Greedy action for one frame stack
+    def get_best_action(self, state):
+        return self.act(state[np.newaxis])[0]
+
+    # One session.run: the global step increment and periodic target network update, followed by
+    # gradient_steps_per_call optimizer updates
     def train(self):
-        batch = self.exp_history.sample_mini_batch(self.batchsize)
+        n = self.batchsize * self.gradient_steps_per_call
+        with self.profiler.phase("sample"):
+            if self.prefetch_batches > 0:
+                if self.prefetcher is None:
+                    self.prefetcher = BatchPrefetcher(self.exp_history, n, self.prefetch_batches, self.replay_lock)
+                batch = self.prefetcher.get()
+            else:
+                batch = self.exp_history.sample_mini_batch(n)
         # Feed dict
         fd = {
-            self.input_reward: "reward",
-            self.input_prev_state: "prev_state",
-            self.input_next_state: "next_state",
-            self.input_actions: "actions",
-            self.input_done_mask: "done_mask"
+            self.fused_reward: "reward",
+            self.fused_prev_state: "prev_state",
+            self.fused_next_state: "next_state",
+            self.fused_actions: "actions",
+            self.fused_done_mask: "done_mask"
         }
         fd1 = {ph: batch[k] for ph, k in fd.items()}
-        self.session.run([self.train_op], fd1)
+        fetches = [self.fused_train_op]
+        if "weights" in batch:
+            fd1[self.fused_weights] = batch["weights"]
+            fetches.append(self.fused_td_errors)
+
+        self.train_calls += 1
+        run_kwargs = {}
+        if self.timeline_dir is not None and self.train_calls % self.timeline_every == 0:
+            import tensorflow as tf
+            run_kwargs = dict(
+                options=tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.FULL_TRACE),
+                run_metadata=tf.compat.v1.RunMetadata())
+        with self.profiler.phase("session_run"):
+            results = self.session.run(fetches, fd1, **run_kwargs)
+        if run_kwargs:
+            self.write_timeline(run_kwargs["run_metadata"])
+
+        if "weights" in batch:
+            with self.profiler.phase("update_priorities"):
+                with self.replay_lock:
+                    self.exp_history.update_priorities(batch["indices"], results[1])
+
+    def write_timeline(self, run_metadata):
+        from tensorflow.python.client import timeline
+        os.makedirs(self.timeline_dir, exist_ok=True)
+        path = os.path.join(self.timeline_dir, "train_%i.json" % self.train_calls)
+        with open(path, "w") as f:
+            f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
 
     def play_episode(self, render, load_checkpoint):
         eh = (
@@ -184,40 +358,46 @@ class DQN:
         total_reward = 0
         total_score = 0
         frames_in_episode = 0
+        # Phase timings are aggregated per episode
+        profiler = self.profiler
+        profiler.reset()
 
-        first_frame = self.env.reset()
-        first_frame_pp = processimage.process_image(first_frame)
+        # Frames are processed straight into the dtype the replay stores
+        frame = np.empty(self.observation_shape, dtype=eh.frame_dtype)
+        with profiler.phase("env_reset"):
+            first_frame = self.env.reset()
+        self.process_observation(first_frame, frame)
 
-        eh.start_new_episode(first_frame_pp)
+        eh.start_new_episode(frame)
+        self.frame_stack.reset(frame)
 
         epsilon = self.get_epsilon()
         while True:
-            if np.random.rand() >= epsilon:
-                action_idx = self.session.run(self.best_action, {self.input_prev_state: eh.current_state()[np.newaxis, ...]})[0]
-            else:
-                action_idx = self.get_random_action()
+            with profiler.phase("act"):
+                if np.random.rand() >= epsilon:
+                    action_idx = self.act(self.frame_stack.states)[0]
+                else:
+                    action_idx = self.get_random_action()
 
             if self.action_map is not None:
                 action = self.action_map[action_idx]
             else:
                 action = action_idx
 
-            reward = 0
-            score = 0
-            for _ in range(self.frame_skip):
-                observation, r, done, info = self.env.step(action)
-                if render:
+            # The environment repeats the action frame_skip times and renders only the last sub-step
+            with profiler.phase("env_step"):
+                observation, score, done, info = self.env.step(action, self.frame_skip)
+            if render:
+                with profiler.phase("env_render"):
                     self.env.render()
 
-                score += r
-                #Increase rewards on the last frames if reward is positive
+            #Increase rewards on the last frames if reward is positive
+            reward = 0
+            for r in info["rewards"]:
                 if r > 0:
                     r = r + frames_in_episode*0.2 #in 230 frames late game it adds +- 50 reward to tiles
                 reward += r
 
-                if done:
-                    break
-
             early_done, punishment = self.check_early_stop(reward, total_reward, frames_in_episode)
             if early_done:
                 reward += punishment
@@ -227,23 +407,27 @@ class DQN:
             total_reward += reward
             total_score += score
             frames_in_episode += 1
-            observation = processimage.process_image(observation)
-            eh.add_experience(observation, action_idx, done, reward)
+            with profiler.phase("process_image"):
+                self.process_observation(observation, frame)
+            with profiler.phase("replay_add"):
+                with self.replay_lock:
+                    eh.add_experience(frame, action_idx, done, reward)
+            self.frame_stack.push(frame)
 
             if self.do_training:
                 self.global_counter += 1
-                step = self.session.run(self.increment_global_step_op)
-                if self.global_counter % self.target_network_update_freq:
-                    self.update_target_network()
+            if self.do_training and self.train_during_episodes:
+                # Each branch is a single session.run that also advances the global step and updates the target network
                 train_cond = (self.exp_history.counter >= self.min_experience_size and self.global_counter % self.train_freq == 0)
                 if train_cond:
-                    self.train()
+                    with profiler.phase("train"):
+                        self.train()
+                else:
+                    with profiler.phase("global_step"):
+                        self.session.run(self.step_op)
 
             if done:
                 if self.do_training:
                     self.episode_counter += 1
 
                 return total_score, total_reward, frames_in_episode, epsilon
-
-    def update_target_network(self):
-        self.session.run(self.copy_network_ops)
\ No newline at end of file
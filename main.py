@@ -1,34 +1,67 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from car_dqn import CarRacingDQN
-from RaceCarEnv import RaceCarEnv
+from RaceCarEnv import RaceCarEnv, STATE_FEATURES
+from Track import DEFAULT_TRACK
+from NumpyPolicy import NumpyPolicy
+from MetricsWriter import MetricsWriter, RollingMean
+from CheckpointManager import CheckpointManager, load_index
+from RenderCache import RenderCache
 import os
-import tensorflow as tf
 import _thread
-import re
 import sys
+import time
 import numpy as np
 import argparse
 
 print("Starting...")
-#Ensure its running on GPU
-print("Num GPUs Available: ", len(tf.config.experimental.list_physical_devices('GPU')))
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--validation', choices=('True', 'False'), required=True, help="Flag(True, False) to check if you want to validate a trained model")
 parser.add_argument('--load_checkpoint',  choices=('True', 'False'), required=True, help="Flag(True, False) to check if you want to load the current model and train it")
+parser.add_argument('--render_backend', choices=('opengl', 'offscreen', 'software'), default='opengl', help="Renderer used for the observations, offscreen draws them at observation size and software runs headless without a display")
+parser.add_argument('--track', default=DEFAULT_TRACK, help="Track file the car drives on, see Track.load_track")
+parser.add_argument('--observation', choices=('image', 'state'), default='image', help="Observations of the agent, state trains a multilayer perceptron on feature vectors of the car and track without rendering")
+parser.add_argument('--show_window', choices=('True', 'False'), default='True', help="Flag(True, False) to show the window of the offscreen renderer")
+parser.add_argument('--display_fps', type=float, default=30, help="Most refreshes of the window per second with the opengl and offscreen renderers")
+parser.add_argument('--render_cache', choices=('True', 'False'), default='False', help="Flag(True, False) to reuse the observations of car poses that were already rendered")
+parser.add_argument('--render_cache_mb', type=int, default=256, help="Megabytes of observations kept by --render_cache True")
+parser.add_argument('--render_cache_position_step', type=float, default=0.05, help="Metres the positions of the render cache are quantized to")
+parser.add_argument('--render_cache_heading_step', type=float, default=0.5, help="Degrees the headings of the render cache are quantized to")
+parser.add_argument('--replay_dir', default=None, help="Directory for a disk-backed experience replay, reopened with --load_checkpoint True")
+parser.add_argument('--prioritized_replay', choices=('True', 'False'), default='False', help="Flag(True, False) to sample experiences by TD error instead of uniformly")
+parser.add_argument('--prefetch_batches', type=int, default=0, help="Number of mini batches sampled ahead on a background thread, 0 samples in the training step")
+parser.add_argument('--gradient_steps_per_call', type=int, default=1, help="Optimizer updates per training session.run, each on its own mini batch")
+parser.add_argument('--profile', choices=('True', 'False'), default='False', help="Flag(True, False) to time the phases of every episode and add them to the episode summary")
+parser.add_argument('--timeline_dir', default=None, help="Directory for TensorFlow timelines of sampled train steps")
+parser.add_argument('--timeline_every', type=int, default=1000, help="Train steps between two timelines written to --timeline_dir")
+parser.add_argument('--metrics', nargs='*', choices=('csv', 'jsonl'), default=[], help="Additional formats of the episode records, written next to train24.txt")
+parser.add_argument('--tensorboard_dir', default=None, help="Directory for TensorBoard summaries of the episode records")
+parser.add_argument('--keep_checkpoints', type=int, default=5, help="Number of most recent checkpoints kept")
+parser.add_argument('--keep_best_checkpoints', type=int, default=3, help="Number of checkpoints with the highest average 100 score kept besides the most recent ones")
+parser.add_argument('--metrics_flush_interval', type=float, default=5.0, help="Seconds between flushes of the episode records")
+parser.add_argument('--inference', choices=('tensorflow', 'numpy'), default='tensorflow', help="Network used for validation, numpy plays with the weights exported by NumpyPolicy.py without importing TensorFlow")
 args = parser.parse_args()
+if args.gradient_steps_per_call < 1:
+    parser.error("--gradient_steps_per_call must be at least 1")
 
 validation = args.validation == "True"
 load_checkpoint = args.load_checkpoint == "True"
+numpy_inference = args.inference == "numpy"
+assert validation or not numpy_inference, "--inference numpy only plays, use it with --validation True"
+
+if not numpy_inference:
+    import tensorflow as tf
+    #Ensure its running on GPU
+    print("Num GPUs Available: ", len(tf.config.experimental.list_physical_devices('GPU')))
 
 if validation:
     load_checkpoint = True
-checkpoint_path = "data/checkpoints/train24"
+# Models of state observations have other weights, so they are kept apart
+checkpoint_path = "data/checkpoints/train24" if args.observation == 'image' else "data/checkpoints/train24_state"
 train_episodes = 15000
 save_freq_episodes = train_episodes/100
 finished = False
 opendir = checkpoint_path + '.txt'
-text_results = open(opendir, "w")
 render = False
 
 frame_skip = 3 #frame_skip number n. model is trained n to n times only
@@ -45,64 +78,98 @@ model_config = dict(
     target_network_update_freq=int(1000), #Updates the target network every 10000 global steps by copying them from the prediction network to the target network
     gamma=0.95,
     render=False,
+    replay_dir=args.replay_dir,
+    resume_replay=load_checkpoint,
+    prioritized_replay=args.prioritized_replay == "True",
+    prefetch_batches=args.prefetch_batches,
+    gradient_steps_per_call=args.gradient_steps_per_call,
+    profile=args.profile == "True",
+    timeline_dir=args.timeline_dir,
+    timeline_every=args.timeline_every,
+    state_features=STATE_FEATURES if args.observation == 'state' else None,
 )
 
-dqn_scores = []
-eps_history = []
-avg_score_all = [0]
+# Episode records go to train24.txt and the formats selected with --metrics on a background thread
+metrics = MetricsWriter(
+    text_path=opendir,
+    csv_path=checkpoint_path + '.csv' if 'csv' in args.metrics else None,
+    jsonl_path=checkpoint_path + '.jsonl' if 'jsonl' in args.metrics else None,
+    tensorboard_dir=args.tensorboard_dir,
+    flush_interval=args.metrics_flush_interval,
+)
+score_window = RollingMean(100)
+max_avg_score = 0
 
 print ("Loading Env")
-env = RaceCarEnv()
+graphics_options = None
+if args.render_backend != 'software':
+    graphics_options = {'display_fps': args.display_fps}
+    if args.render_backend == 'offscreen':
+        graphics_options['show_window'] = args.show_window == "True"
+render_cache = dict(position_step=args.render_cache_position_step, heading_step=args.render_cache_heading_step,
+    max_bytes=args.render_cache_mb * 2**20) if args.render_cache == "True" else None
+env = RaceCarEnv(render_backend=args.render_backend, graphics_options=graphics_options, track_path=args.track,
+    observation=args.observation, render_cache=render_cache)
 env.update_validation(validation)
 print("Env Loaded")
 
-tf.compat.v1.reset_default_graph
-
 dqn_agent = CarRacingDQN(env=env, **model_config)
-dqn_agent.build_graph()
-sess = tf.InteractiveSession()
-dqn_agent.session = sess
-
-#Initialize save checkpoints
-saver = tf.train.Saver(max_to_keep=1000) #max number of checkpoints = 500
-#Choice to load checkpoints
-if load_checkpoint:
-    if validation:
-        dqn_agent.do_training = False
+print("Experience replay uses %.2f GB" % (dqn_agent.exp_history.memory_usage() / 1e9))
+checkpoints = None
+if numpy_inference:
+    # The best checkpoint of the index, or the weights exported from a tf.train.Saver checkpoint
+    best = max(load_index(checkpoint_path), key=lambda c: c["score"], default=None)
+    weights_path = os.path.join(checkpoint_path, best["path"]) if best else checkpoint_path + ".npz"
+    assert os.path.exists(weights_path), "%s not found, export it with python NumpyPolicy.py" % weights_path
+    print("loading the exported weights from %s" % weights_path)
+    dqn_agent.policy = NumpyPolicy(weights_path)
+    dqn_agent.do_training = False
     train_episodes = 1500
     save_freq_episodes = 150
-    print("loading the latest checkpoint from %s" % checkpoint_path)
-    ckpt = tf.train.get_checkpoint_state(checkpoint_path)
-    assert ckpt, "checkpoint path %s not found" % checkpoint_path
-    global_counter = int(re.findall("-(\d+)$", ckpt.model_checkpoint_path)[0])
-    saver.restore(sess, ckpt.model_checkpoint_path)
-    dqn_agent.global_counter = global_counter
     render = True
 else:
-    if checkpoint_path is not None:
-        assert not os.path.exists(checkpoint_path), \
-            "checkpoint path already exists but load_checkpoint is false"
+    tf.compat.v1.reset_default_graph
+    dqn_agent.build_graph()
+    sess = tf.InteractiveSession()
+    dqn_agent.session = sess
+
+    #Initialize save checkpoints, written in the background and pruned to the latest and best ones
+    checkpoints = CheckpointManager(sess, checkpoint_path, tf.global_variables(),
+        keep_last=args.keep_checkpoints, keep_best=args.keep_best_checkpoints)
+    #Choice to load checkpoints
+    if load_checkpoint:
+        if validation:
+            dqn_agent.do_training = False
+        train_episodes = 1500
+        save_freq_episodes = 150
+        # Validation plays the best checkpoint, training resumes from the latest one
+        entry = checkpoints.best() if validation else checkpoints.latest()
+        entry = checkpoints.restore(entry) if entry else checkpoints.restore_saver_checkpoint()
+        assert entry, "checkpoint path %s not found" % checkpoint_path
+        print("loaded the checkpoint %s from %s - step %d, average 100 score %.2f" %
+            (entry["path"], checkpoint_path, entry["step"], entry["score"]))
+        dqn_agent.global_counter = entry["step"]
+        render = True
+    else:
+        if checkpoint_path is not None:
+            assert not os.path.exists(checkpoint_path), \
+                "checkpoint path already exists but load_checkpoint is false"
 
-    tf.global_variables_initializer().run()
+        tf.global_variables_initializer().run()
 
-def save_checkpoint():
-    if not os.path.exists(checkpoint_path):
-        os.makedirs(checkpoint_path)
-    p = os.path.join(checkpoint_path, "m.ckpt")
-    saver.save(sess, p, dqn_agent.global_counter)
-    print("saved to %s - %d" % (p, dqn_agent.global_counter))
+def save_checkpoint(avg_score):
+    entry = checkpoints.save(dqn_agent.global_counter, dqn_agent.episode_counter, avg_score)
+    dqn_agent.exp_history.flush()
+    print("saving to %s - %d" % (checkpoints.checkpoint_file(entry), dqn_agent.global_counter))
 
-def one_episode(eps_history,dqn_scores,avg_score_all,render,load_checkpoint):
+def one_episode(render,load_checkpoint):
+    global max_avg_score
     score, reward, frames, epsilon = dqn_agent.play_episode(render, load_checkpoint)
 
-    eps_history.append(epsilon)
-
-    dqn_scores.append(score)
     i = dqn_agent.episode_counter
-    avg_score = np.mean(dqn_scores[max(0, i - 100):(i + 1)])
-    avg_score_all.append(avg_score)
-    max_avg_score = max(avg_score_all)
+    avg_score = score_window.add(score)
     if avg_score >= max_avg_score:
+        max_avg_score = avg_score
         new_max = ' => New HighScore! <= '
         highscore = True
     else:
@@ -111,32 +178,40 @@ def one_episode(eps_history,dqn_scores,avg_score_all,render,load_checkpoint):
 
     strm = ("#> episode: %i | score: %.2f | total steps: %i | epsilon: %.5f | average 100 score: %.2f" %
             (i, score, dqn_agent.global_counter, epsilon, avg_score))
-
+    record = dict(episode=i, score=float(score), reward=float(reward), frames=frames, epsilon=epsilon,
+        total_steps=dqn_agent.global_counter, average_score=avg_score, time=time.time())
+
+    if dqn_agent.prefetcher is not None:
+        strm += " | prefetch overlap: %.2f" % dqn_agent.prefetcher.overlap()
+        record["prefetch_overlap"] = dqn_agent.prefetcher.overlap()
+    if isinstance(env.graphics, RenderCache):
+        strm += " | render cache hit rate: %.2f" % env.graphics.hit_rate()
+        record["render_cache_hit_rate"] = env.graphics.hit_rate()
+    if dqn_agent.profiler.enabled:
+        strm += " | profile: " + dqn_agent.profiler.format()
+        for phase, (total, count) in dqn_agent.profiler.summary().items():
+            record[phase + "_ms"] = 1e3 * total / max(count, 1)
     if validation:
         print ("Validating Model - No Training is being Done")
     print(strm + new_max)
 
-    text_results = open(opendir, "a")
-    text_results.write(strm + new_max + '\n')
-    text_results.close()
+    metrics.write(record, strm + new_max)
     save_cond = (
         dqn_agent.episode_counter % save_freq_episodes == 0
         and checkpoint_path is not None
         and dqn_agent.do_training)
     if not load_checkpoint:
         if save_cond or (highscore and dqn_agent.episode_counter > 100):
-            save_checkpoint()
+            save_checkpoint(avg_score)
     if load_checkpoint and save_cond:
         if not validation: 
-            save_checkpoint()
-    
-    return eps_history,dqn_scores,avg_score_all
+            save_checkpoint(avg_score)
 
 def input_thread(list):
     input("...enter to stop after current episode\n")
     list.append("OK")
 
-def main_loop(eps_history,dqn_scores,avg_score_all,render,load_checkpoint):
+def main_loop(render,load_checkpoint):
     #call training loop
     list = []
     _thread.start_new_thread(input_thread, (list,))
@@ -145,18 +220,22 @@ def main_loop(eps_history,dqn_scores,avg_score_all,render,load_checkpoint):
             break
         if dqn_agent.do_training and dqn_agent.episode_counter >= train_episodes:
             break
-        eps_history,dqn_scores,avg_score_all = one_episode(eps_history,dqn_scores,avg_score_all,render,load_checkpoint)
+        one_episode(render,load_checkpoint)
 
     print("done")
-    text_results.close()
+    if dqn_agent.do_training:
+        dqn_agent.exp_history.flush()
+    if checkpoints is not None:
+        checkpoints.wait()
+    metrics.close()
     exit()
 
 if train_episodes > 0 and dqn_agent.episode_counter < train_episodes and not load_checkpoint :
     print("now training... you can early stop with enter...")
     sys.stdout.flush()
-    main_loop(eps_history,dqn_scores,avg_score_all,render,load_checkpoint)
+    main_loop(render,load_checkpoint)
 
 else:
     print("now just playing...")
     sys.stdout.flush()
-    main_loop(eps_history,dqn_scores,avg_score_all,render,load_checkpoint)
\ No newline at end of file
+    main_loop(render,load_checkpoint)
\ No newline at end of file
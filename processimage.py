@@ -1,10 +1,78 @@
 import numpy as np
 from skimage import color
 
+# Weights of skimage's rgb2gray (0.2125, 0.7154, 0.0721) scaled to integers. The luminance of a uint8
+# pixel is then an integer between 0 and LUMINANCE_SCALE, computed exactly in float32 since it stays
+# below 2**24
+LUMINANCE_WEIGHTS = np.array([2125, 7154, 721], dtype=np.float32)
+LUMINANCE_SCALE = 255 * 10000
+
+# Lookup tables of process_image per output dtype, built on first use
+_tables = {}
+
+# Converts float frames in the [-1, 1] range to dtype, uint8 with the encoding of ExperienceReplay
+def _to_dtype(frames, dtype):
+    if dtype == np.uint8:
+        return np.rint((frames + 1) * 127.5).clip(0, 255).astype(np.uint8)
+    return frames.astype(dtype)
+
+def _substitute_grey(obs_gray):
+    obs_gray[abs(obs_gray - 0.68616) < 0.0001] = 1
+    obs_gray[abs(obs_gray - 0.75630) < 0.0001] = 1
+    return 2 * obs_gray - 1
+
+# Maps every integer luminance to the processed value in dtype, held as float32 which represents all
+# uint8 and float16 values exactly. rgb2gray only approximates the exact luminance in float64, so
+# luminances whose result could round either way (exact ties, the grey substitution thresholds, float
+# rounding boundaries) are NaN and recomputed with process_image_reference
+def _lookup_table(dtype):
+    dtype = np.dtype(dtype)
+    if dtype not in _tables:
+        assert dtype in (np.uint8, np.float16, np.float32), "unsupported dtype %s" % dtype
+        gray = np.arange(LUMINANCE_SCALE + 1) / LUMINANCE_SCALE
+        values = _to_dtype(_substitute_grey(gray.copy()), dtype)
+        table = values.astype(np.float32)
+        # rgb2gray stays within 2.3e-16 of the exact luminance for every uint8 colour
+        for error in (-1e-15, 1e-15):
+            table[_to_dtype(_substitute_grey(gray + error), dtype) != values] = np.nan
+        _tables[dtype] = table
+    return _tables[dtype]
+
 class processimage:
-    def process_image(obs):
+    # Original preprocessing: grayscale in [-1, 1] as float64, with the two track greys turned white.
+    # process_image gives the same values without the float64 passes
+    def process_image_reference(obs):
         obs1 = obs.astype(np.uint8)
         obs_gray = color.rgb2gray(obs1)
-        obs_gray[abs(obs_gray - 0.68616) < 0.0001] = 1
-        obs_gray[abs(obs_gray - 0.75630) < 0.0001] = 1
-        return 2 * obs_gray - 1
\ No newline at end of file
+        return _substitute_grey(obs_gray)
+
+    # Processes one uint8 frame of shape (H, W, 3). The result is written into out when it is given,
+    # otherwise into a new array of dtype
+    def process_image(obs, out=None, dtype=np.float32):
+        if out is None:
+            out = np.empty(obs.shape[:-1], dtype=dtype)
+        processimage.process_images(obs[np.newaxis], out[np.newaxis])
+        return out
+
+    # Processes N frames of shape (N, H, W, 3) at once, equal to process_image_reference cast to the
+    # dtype of out (uint8 with the encoding of ExperienceReplay)
+    def process_images(observations, out=None, dtype=np.float32):
+        observations = np.asarray(observations, dtype=np.uint8)
+        if out is None:
+            out = np.empty(observations.shape[:-1], dtype=dtype)
+        table = _lookup_table(out.dtype)
+
+        luminance = np.dot(observations.reshape(-1, 3).astype(np.float32), LUMINANCE_WEIGHTS).astype(np.intp)
+        processed = out if out.dtype == np.float32 else np.empty(out.shape, dtype=np.float32)
+        np.take(table, luminance.reshape(out.shape), out=processed, mode='clip')
+        if processed is not out:
+            # NaNs are replaced below
+            with np.errstate(invalid='ignore'):
+                out[...] = processed
+
+        # The float64 result of rgb2gray for a pixel depends on the layout of the whole frame, so frames
+        # with ambiguous pixels are recomputed as a whole. Rendered frames are grey and never hit this
+        recompute = np.isnan(processed).reshape(len(observations), -1).any(axis=1)
+        for i in np.flatnonzero(recompute):
+            out[i] = _to_dtype(processimage.process_image_reference(observations[i]), out.dtype)
+        return out